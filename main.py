@@ -2,17 +2,31 @@ import asyncio
 import os
 import sys
 import logging
-import subprocess
 import psutil
+import resource
 import sqlite3
 import hashlib
 import json
+import signal
+import socket
+import subprocess
+import html
+import re
+import heapq
+import time
 import zipfile
+import shutil
+import tempfile
+import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiohttp import web
 import aiohttp
 from pathlib import Path
@@ -29,6 +43,11 @@ OWNER_ID_STR = os.getenv("OWNER_ID_STR")
 ADMIN_ID_STR = os.getenv("ADMIN_ID_STR")
 YOUR_USERNAME = os.getenv("YOUR_USERNAME")
 UPDATE_CHANNEL = os.getenv("UPDATE_CHANNEL")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEB_SERVER_PORT = int(os.getenv("PORT", "5000"))
+NODE_ID = os.getenv("NODE_ID")
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
 
 if not TOKEN:
     logger.error("BOT_TOKEN not found in environment variables!")
@@ -47,37 +66,2773 @@ except ValueError:
 
 YOUR_USERNAME = YOUR_USERNAME or '@zioniiix'
 UPDATE_CHANNEL = UPDATE_CHANNEL or 'https://t.me/zionix_portal'
+WEBHOOK_SECRET = WEBHOOK_SECRET or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()
 
 BASE_DIR = Path(__file__).parent.absolute()
 UPLOAD_BOTS_DIR = BASE_DIR / 'upload_bots'
 IROTECH_DIR = BASE_DIR / 'inf'
 DATABASE_PATH = IROTECH_DIR / 'bot_data.db'
+BLOB_STORE_DIR = UPLOAD_BOTS_DIR / '.blobs'
+BLOB_TMP_DIR = BLOB_STORE_DIR / 'tmp'
+DEPS_DIR = UPLOAD_BOTS_DIR / '.deps'
+DEPS_WHEELHOUSE = DEPS_DIR / 'wheels'
+DEPS_PIP_CACHE = DEPS_DIR / 'cache' / 'pip'
+DEPS_NPM_CACHE = DEPS_DIR / 'cache' / 'npm'
+NODE_MARKERS_DIR = UPLOAD_BOTS_DIR / '.nodes'
 
 FREE_USER_LIMIT = 20
 SUBSCRIBED_USER_LIMIT = 50
 ADMIN_LIMIT = 999
 OWNER_LIMIT = float('inf')
 
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_MAX_CONNECTIONS = 40
+UPDATE_MAX_CONCURRENCY = 100
+UPDATE_MAX_PENDING = 1000
+DB_STATEMENT_CACHE_SIZE = 256
+DB_BUSY_TIMEOUT_MS = 5000
+USER_CACHE_SIZE = 10000
+NODE_HEARTBEAT_INTERVAL = 10
+NODE_TIMEOUT = 45
+STATE_SYNC_INTERVAL = 1
+STATE_SYNC_BATCH = 500
+STATE_EVENT_RETENTION = 3600
+GLOBAL_COUNTS_REFRESH_INTERVAL = 60
+WRITE_BEHIND_FLUSH_INTERVAL = 5
+WRITE_BEHIND_MAX_PENDING = 1000
+METRICS_SAMPLE_INTERVAL = 5
+METRICS_HISTORY_SIZE = 120
+TELEGRAM_GLOBAL_RATE = 25
+TELEGRAM_GLOBAL_BURST = 30
+BROADCAST_CONCURRENCY = 20
+BROADCAST_MAX_RETRIES = 5
+BROADCAST_BACKOFF_BASE = 1
+BROADCAST_PAGE_SIZE = 1000
+BROADCAST_SAVE_BATCH = 200
+BROADCAST_PROGRESS_INTERVAL = 5
+WORKER_POOL_SIZE = 4
+ZIP_MAX_ENTRIES = 5000
+ZIP_MAX_TOTAL_SIZE = 500 * 1024 * 1024
+ZIP_MAX_COMPRESSION_RATIO = 100
+ZIP_RATIO_MIN_SIZE = 1024 * 1024
+ZIP_CHUNK_SIZE = 1024 * 1024
+ZIP_PROGRESS_INTERVAL = 2
+UPLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_WRITE_BUFFER = 1024 * 1024
+UPLOAD_TIMEOUT = 300
+UPLOAD_PROGRESS_MIN_SIZE = 1024 * 1024
+UPLOAD_PROGRESS_INTERVAL = 2
+UPLOAD_MAX_CONCURRENT = 16
+UPLOAD_MAX_INFLIGHT_BYTES = 200 * 1024 * 1024
+UPLOAD_USER_INFLIGHT = {'free': 2, 'premium': 5, 'admin': 10}
+SEARCH_PAGE_SIZE = 20
+SCRIPT_HISTORY_SIZE = 50
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUP_COUNT = 2
+LOG_TAIL_LINES = 40
+LOG_PUMP_DRAIN_TIMEOUT = 5
+LOG_TAIL_BLOCK_SIZE = 8192
+LOG_VIEW_MAX_CHARS = 3500
+LIVE_TAIL_INTERVAL = 3
+RESTART_POLICIES = ('never', 'on-failure', 'always')
+RESTART_BACKOFF_BASE = 2
+RESTART_BACKOFF_MAX = 300
+RESTART_STABLE_SECONDS = 60
+RESTART_BUDGET_PER_HOUR = 30
+CRASH_LOOP_WINDOW = 600
+CRASH_LOOP_THRESHOLD = 5
+STOP_GRACE_PERIOD = 5
+ADMISSION_MAX_RUNNING = 250
+ADMISSION_TIER_CAPS = {'free': 150, 'premium': 200, 'admin': None}
+ADMISSION_MIN_AVAILABLE_MB = 512
+ADMISSION_DEFAULT_SCRIPT_MB = 128
+ADMISSION_RECHECK_INTERVAL = 5
+ADMISSION_MAX_QUEUE = 1000
+TIER_PRIORITY = {'admin': 0, 'premium': 1, 'free': 2}
+LIVE_TAIL_MAX_ACTIVE = 500
+WARM_POOL_ENABLED = True
+WARM_POOL_PRELOAD = ['asyncio', 'json', 'ssl', 'sqlite3', 'aiohttp', 'aiogram', 'requests', 'telebot']
+WARM_POOL_SPAWN_TIMEOUT = 5
+DEPS_OFFLINE = False
+DEPS_BUILD_CONCURRENCY = 2
+DEPS_BUILD_TIMEOUT = 900
+DEPS_GC_GRACE = 7 * 24 * 3600
+SCRIPT_LIMITS = {
+    'free': {'cpu_seconds': 2 * 3600, 'memory_mb': 256, 'open_files': 256, 'processes': 64,
+             'nice': 10, 'ionice': psutil.IOPRIO_CLASS_IDLE, 'max_scripts': 3},
+    'premium': {'cpu_seconds': 8 * 3600, 'memory_mb': 768, 'open_files': 1024, 'processes': 256,
+                'nice': 5, 'ionice': psutil.IOPRIO_CLASS_BE, 'max_scripts': 10},
+    'admin': {'cpu_seconds': None, 'memory_mb': None, 'open_files': None, 'processes': None,
+              'nice': 0, 'ionice': None, 'max_scripts': None}
+}
+BLOB_CHUNK_SIZE = 1024 * 1024
+BLOB_GC_INTERVAL = 3600
+BLOB_DEDUP_SUFFIXES = {'.py', '.pyi', '.js', '.mjs', '.cjs', '.ts', '.zip'}
+
 UPLOAD_BOTS_DIR.mkdir(exist_ok=True)
 IROTECH_DIR.mkdir(exist_ok=True)
+BLOB_STORE_DIR.mkdir(exist_ok=True)
+BLOB_TMP_DIR.mkdir(exist_ok=True)
+DEPS_WHEELHOUSE.mkdir(parents=True, exist_ok=True)
 
 bot = Bot(token=TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
 
 bot_scripts = {}
-user_subscriptions = {}
-user_files = {}
-user_favorites = {}
 banned_users = set()
-active_users = set()
+active_user_count = 0
 admin_ids = {ADMIN_ID, OWNER_ID}
 bot_locked = False
 bot_stats = {'total_uploads': 0, 'total_downloads': 0, 'total_runs': 0}
+search_sessions = {}
+search_index_enabled = False
+
+class FileAggregates:
+    def __init__(self):
+        self.type_counts = {}
+        self.total_files = 0
+        self.total_favorites = 0
+        self.premium_active = 0
+        self.premium_expired = 0
+        self._expiries = {}
+        self._expiry_heap = []
+
+    def reset(self, type_counts, total_favorites):
+        self.type_counts = dict(type_counts)
+        self.total_files = sum(self.type_counts.values())
+        self.total_favorites = total_favorites
+
+    def file_added(self, record, previous=None):
+        if previous is not None:
+            self.type_counts[previous.type] -= 1
+        else:
+            self.total_files += 1
+        self.type_counts[record.type] = self.type_counts.get(record.type, 0) + 1
+
+    def file_removed(self, record):
+        self.total_files -= 1
+        self.type_counts[record.type] -= 1
+
+    def favorites_changed(self, delta):
+        self.total_favorites += delta
+
+    def set_subscription(self, user_id, expiry):
+        now = datetime.now()
+        self._refresh_premium(now)
+        previous = self._expiries.get(user_id)
+        if previous is not None:
+            if previous > now:
+                self.premium_active -= 1
+            else:
+                self.premium_expired -= 1
+        self._expiries[user_id] = expiry
+        if expiry > now:
+            self.premium_active += 1
+            heapq.heappush(self._expiry_heap, (expiry, user_id))
+        else:
+            self.premium_expired += 1
+
+    def _refresh_premium(self, now):
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expiry, user_id = heapq.heappop(self._expiry_heap)
+            if self._expiries.get(user_id) == expiry:
+                self.premium_active -= 1
+                self.premium_expired += 1
+
+    def premium_counts(self):
+        self._refresh_premium(datetime.now())
+        return self.premium_active, self.premium_expired
+
+    def premium_users(self):
+        now = datetime.now()
+        return sorted((expiry, user_id) for user_id, expiry in self._expiries.items() if expiry > now)
+
+aggregates = FileAggregates()
+
+class FileRecord:
+    __slots__ = ('name', 'type', 'upload_date', 'digest', 'size', 'mtime', 'lines')
+
+    def __init__(self, name, file_type, upload_date=None, digest=None, size=None, mtime=None, lines=None):
+        self.name = name
+        self.type = file_type
+        self.upload_date = upload_date
+        self.digest = digest
+        self.size = size
+        self.mtime = mtime
+        self.lines = lines
+
+    def update_metadata(self, metadata):
+        self.digest = metadata.get('digest')
+        self.size = metadata.get('size')
+        self.mtime = metadata.get('mtime')
+        self.lines = metadata.get('lines')
+
+class UserFileIndex:
+    __slots__ = ('user_id', 'files', 'favorites')
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.files = {}
+        self.favorites = set()
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, file_name):
+        return file_name in self.files
+
+    def __iter__(self):
+        return iter(self.files.values())
+
+    def get(self, file_name):
+        return self.files.get(file_name)
+
+    def load(self, files, favorites):
+        self.files = {row[0]: FileRecord(*row) for row in files}
+        self.favorites = {file_name for (file_name,) in favorites}
+
+    def add(self, record):
+        previous = self.files.get(record.name)
+        self.files[record.name] = record
+        aggregates.file_added(record, previous)
+        return previous
+
+    def remove(self, file_name):
+        self.remove_favorite(file_name)
+        record = self.files.pop(file_name, None)
+        if record is not None:
+            aggregates.file_removed(record)
+        return record
+
+    def is_favorite(self, file_name):
+        return file_name in self.favorites
+
+    def add_favorite(self, file_name):
+        if file_name not in self.favorites:
+            self.favorites.add(file_name)
+            aggregates.favorites_changed(1)
+
+    def remove_favorite(self, file_name):
+        if file_name in self.favorites:
+            self.favorites.remove(file_name)
+            aggregates.favorites_changed(-1)
+
+    def count_type(self, file_type):
+        return sum(1 for record in self.files.values() if record.type == file_type)
+
+class UserState:
+    __slots__ = ('files', 'subscription', 'known', 'pins')
+
+    def __init__(self, user_id, files, favorites, expiry, known):
+        self.files = UserFileIndex(user_id)
+        self.files.load(files, favorites)
+        self.subscription = None
+        if expiry:
+            try:
+                self.subscription = datetime.fromisoformat(expiry)
+            except ValueError:
+                logger.warning(f"Invalid expiry date for user {user_id}")
+        self.known = known
+        self.pins = 0
+
+def get_user_index(user_id):
+    return user_cache.get(user_id).files
+
+def get_subscription_expiry(user_id):
+    return user_cache.get(user_id).subscription
+
+def set_user_subscription(user_id, expiry):
+    state = user_cache.peek(user_id)
+    if state is not None:
+        state.subscription = expiry
+    aggregates.set_subscription(user_id, expiry)
+
+class Database:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, cached_statements=DB_STATEMENT_CACHE_SIZE)
+            try:
+                conn.execute(f'PRAGMA journal_mode={DB_JOURNAL_MODE}')
+                conn.execute('PRAGMA synchronous=NORMAL')
+                conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+                conn.execute('PRAGMA recursive_triggers=ON')
+            except sqlite3.DatabaseError as e:
+                logger.warning(f"Could not apply SQLite pragmas: {e}")
+            self._conn = conn
+        return self._conn
+
+    def _invoke(self, fn, args):
+        return fn(self._connection(), *args)
+
+    def call(self, fn, *args):
+        return self._executor.submit(self._invoke, fn, args).result()
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._invoke, fn, args)
+
+    async def execute(self, sql, params=()):
+        return await self.run(_db_execute, sql, params)
+
+    async def executemany(self, sql, seq_of_params):
+        return await self.run(_db_executemany, sql, list(seq_of_params))
+
+    async def transaction(self, statements):
+        return await self.run(_db_transaction, list(statements))
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(_db_fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(_db_fetchall, sql, params)
+
+    def close(self):
+        def _close(conn):
+            conn.close()
+            self._conn = None
+        if self._conn is not None:
+            self.call(_close)
+        self._executor.shutdown(wait=True)
+
+def _db_execute(conn, sql, params):
+    with conn:
+        return conn.execute(sql, params).rowcount
+
+def _db_executemany(conn, sql, seq_of_params):
+    with conn:
+        return conn.executemany(sql, seq_of_params).rowcount
+
+def _db_transaction(conn, statements):
+    with conn:
+        for sql, params in statements:
+            conn.execute(sql, params)
+    return len(statements)
+
+def _db_fetchone(conn, sql, params):
+    return conn.execute(sql, params).fetchone()
+
+def _db_fetchall(conn, sql, params):
+    return conn.execute(sql, params).fetchall()
+
+def load_node_id(conn):
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('node_id', ?)", (f"node-{os.urandom(4).hex()}",))
+    return conn.execute("SELECT value FROM settings WHERE key = 'node_id'").fetchone()[0]
+
+db = Database(DATABASE_PATH)
+NODE_ID = NODE_ID or db.call(load_node_id)
+WARM_POOL_SOCKET = Path(os.getenv('XDG_RUNTIME_DIR') or tempfile.gettempdir()) / f'warm_pool-{NODE_ID}.sock'
+
+dp = Dispatcher(storage=MemoryStorage())
+
+def load_user_state(conn, user_id):
+    files = conn.execute('SELECT file_name, file_type, upload_date, digest, size, mtime, line_count FROM user_files '
+                         'WHERE user_id = ?', (user_id,)).fetchall()
+    favorites = conn.execute('SELECT file_name FROM favorites WHERE user_id = ?', (user_id,)).fetchall()
+    subscription = conn.execute('SELECT expiry FROM subscriptions WHERE user_id = ?', (user_id,)).fetchone()
+    known = conn.execute('SELECT 1 FROM active_users WHERE user_id = ?', (user_id,)).fetchone() is not None
+    return files, favorites, subscription[0] if subscription else None, known
+
+class UserStateCache:
+    def __init__(self, database, capacity):
+        self.db = database
+        self.capacity = capacity
+        self._states = OrderedDict()
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._states)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def peek(self, user_id):
+        return self._states.get(user_id)
+
+    def _lookup(self, user_id):
+        state = self._states.get(user_id)
+        if state is not None:
+            self._states.move_to_end(user_id)
+        return state
+
+    def _store(self, user_id, row):
+        state = self._states.get(user_id)
+        if state is None:
+            state = self._states[user_id] = UserState(user_id, *row)
+            self._evict()
+        return state
+
+    def _evict(self):
+        excess = len(self._states) - self.capacity
+        if excess <= 0:
+            return
+        victims = []
+        for user_id, state in self._states.items():
+            if state.pins == 0:
+                victims.append(user_id)
+                if len(victims) >= excess:
+                    break
+        for user_id in victims:
+            del self._states[user_id]
+        self.evictions += len(victims)
+
+    def get(self, user_id):
+        state = self._lookup(user_id)
+        if state is None:
+            raise LookupError(f"State for user {user_id} is not loaded")
+        return state
+
+    async def ensure(self, user_id):
+        state = self._lookup(user_id)
+        if state is not None:
+            self.hits += 1
+            return state
+        self.misses += 1
+        task = self._loading.get(user_id)
+        if task is None:
+            task = self._loading[user_id] = asyncio.create_task(self.db.run(load_user_state, user_id))
+            task.add_done_callback(lambda _: self._loading.pop(user_id, None))
+        return self._store(user_id, await asyncio.shield(task))
+
+user_cache = UserStateCache(db, USER_CACHE_SIZE)
+
+class WriteBehindBuffer:
+    def __init__(self, database, flush_interval, max_pending):
+        self.db = database
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._counters = {}
+        self._active_users = {}
+        self._pending = 0
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._task = None
+
+    def increment(self, stat_name, amount=1):
+        self._counters[stat_name] = self._counters.get(stat_name, 0) + amount
+        self._mark_pending()
+
+    def pending(self, stat_name):
+        return self._counters.get(stat_name, 0)
+
+    def touch_user(self, user_id, when):
+        self._active_users[user_id] = when
+        self._mark_pending()
+
+    def _mark_pending(self):
+        self._pending += 1
+        if self._pending >= self.max_pending and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        async with self._flush_lock:
+            counters, self._counters = self._counters, {}
+            active, self._active_users = self._active_users, {}
+            pending, self._pending = self._pending, 0
+            if not counters and not active:
+                return
+            statements = [('UPDATE bot_stats SET stat_value = stat_value + ? WHERE stat_name = ?', (amount, name))
+                          for name, amount in counters.items()]
+            statements += [('INSERT INTO active_users (user_id, join_date, last_active) VALUES (?, ?, ?) '
+                            'ON CONFLICT(user_id) DO UPDATE SET last_active = excluded.last_active',
+                            (user_id, when, when))
+                           for user_id, when in active.items()]
+            try:
+                await self.db.transaction(statements)
+            except Exception as e:
+                logger.error(f"Write-behind flush failed, keeping {pending} pending writes: {e}")
+                for name, amount in counters.items():
+                    self._counters[name] = self._counters.get(name, 0) + amount
+                for user_id, when in active.items():
+                    self._active_users.setdefault(user_id, when)
+                self._pending += pending
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+write_behind = WriteBehindBuffer(db, WRITE_BEHIND_FLUSH_INTERVAL, WRITE_BEHIND_MAX_PENDING)
+
+class MetricsSampler:
+    def __init__(self, interval, history_size):
+        self.interval = interval
+        self.history = deque(maxlen=history_size)
+        self._processes = {}
+        self._task = None
+
+    def latest(self):
+        return self.history[-1] if self.history else None
+
+    def trend(self, field, count=5):
+        size = len(self.history)
+        return [self.history[i][field] for i in range(max(0, size - count), size)]
+
+    def script_stats(self, script_key):
+        snapshot = self.latest()
+        if snapshot is None:
+            return None
+        return snapshot['scripts'].get(script_key)
+
+    def _sample_process(self, script_key, pid, process_cap):
+        proc = self._processes.get(script_key)
+        if proc is None or proc.pid != pid:
+            proc = psutil.Process(pid)
+            proc.cpu_percent(interval=None)
+            self._processes[script_key] = proc
+        descendants = proc.children(recursive=True)
+        with proc.oneshot():
+            cpu_times = proc.cpu_times()
+            stats = {
+                'pid': pid,
+                'cpu': proc.cpu_percent(interval=None),
+                'cpu_seconds': cpu_times.user + cpu_times.system + cpu_times.children_user + cpu_times.children_system,
+                'rss': proc.memory_info().rss,
+                'threads': proc.num_threads(),
+                'processes': 1 + len(descendants),
+                'status': proc.status(),
+                'killed': False
+            }
+        if process_cap and stats['processes'] > process_cap:
+            signal_process_tree(pid, signal.SIGKILL, descendants)
+            stats['killed'] = True
+        return stats
+
+    def sample(self, script_pids, process_caps=None):
+        memory = psutil.virtual_memory()
+        disk = psutil.disk_usage('/')
+        scripts = {}
+        for script_key, pid in script_pids.items():
+            try:
+                scripts[script_key] = self._sample_process(script_key, pid, (process_caps or {}).get(script_key))
+            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                self._processes.pop(script_key, None)
+        for script_key in list(self._processes):
+            if script_key not in script_pids:
+                del self._processes[script_key]
+        snapshot = {
+            'time': datetime.now(),
+            'cpu': psutil.cpu_percent(interval=None),
+            'memory_percent': memory.percent,
+            'memory_available': memory.available,
+            'memory_total': memory.total,
+            'disk_percent': disk.percent,
+            'disk_free': disk.free,
+            'disk_total': disk.total,
+            'scripts': scripts
+        }
+        self.history.append(snapshot)
+        return snapshot
+
+    async def refresh(self):
+        script_pids = {key: info['process'].pid for key, info in bot_scripts.items()}
+        process_caps = {key: SCRIPT_LIMITS.get(info.get('tier'), {}).get('processes') for key, info in bot_scripts.items()
+                        if not info.get('stopping')}
+        snapshot = await asyncio.to_thread(self.sample, script_pids, process_caps)
+        for script_key, stats in snapshot['scripts'].items():
+            if stats['killed']:
+                logger.warning(f"Killed {script_key}: {stats['processes']} processes exceed the "
+                               f"limit of {process_caps[script_key]}")
+            info = bot_scripts.get(script_key)
+            if info is not None and info['process'].pid == stats['pid']:
+                info['cpu_seconds'] = max(info.get('cpu_seconds', 0.0), stats['cpu_seconds'])
+                info['peak_rss'] = max(info.get('peak_rss', 0), stats['rss'])
+        return snapshot
+
+    async def _run(self):
+        await asyncio.to_thread(psutil.cpu_percent, None)
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Metrics sampling failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+metrics = MetricsSampler(METRICS_SAMPLE_INTERVAL, METRICS_HISTORY_SIZE)
+
+async def get_metrics_snapshot():
+    snapshot = metrics.latest()
+    if snapshot is None:
+        snapshot = await metrics.refresh()
+    return snapshot
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def try_acquire(self, tokens=1):
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self._refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens=1):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+telegram_limiter = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_BURST)
+
+class UpdateConcurrencyLimiter(BaseMiddleware):
+    def __init__(self, limit):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.pending = 0
+
+    async def __call__(self, handler, event, data):
+        self.pending += 1
+        try:
+            async with self.semaphore:
+                return await handler(event, data)
+        finally:
+            self.pending -= 1
+
+update_limiter = UpdateConcurrencyLimiter(UPDATE_MAX_CONCURRENCY)
+dp.update.outer_middleware(update_limiter)
+
+class UserStateMiddleware(BaseMiddleware):
+    def __init__(self, cache):
+        self.cache = cache
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+        state = await self.cache.ensure(user.id)
+        state.pins += 1
+        try:
+            return await handler(event, data)
+        finally:
+            state.pins -= 1
+
+dp.update.outer_middleware(UserStateMiddleware(user_cache))
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    async def handle(self, request):
+        if update_limiter.pending >= UPDATE_MAX_PENDING:
+            return web.Response(status=503, text="Too many updates in flight")
+        return await super().handle(request)
+
+class BroadcastEngine:
+    def __init__(self, database, limiter, concurrency):
+        self.db = database
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.jobs = {}
+
+    async def create_job(self, text, created_by, chat_id, message_id):
+        await write_behind.flush()
+        return await self.db.run(_create_broadcast_job, text, created_by, chat_id, message_id,
+                                 datetime.now().isoformat())
+
+    def start_job(self, job_id):
+        if job_id not in self.jobs:
+            self.jobs[job_id] = {'task': asyncio.create_task(self._run_job(job_id)),
+                                 'sent': 0, 'failed': 0, 'total': 0}
+
+    async def resume(self):
+        rows = await self.db.fetchall(
+            "SELECT job_id FROM broadcast_jobs WHERE status = 'running' AND (node_id IS NULL OR node_id = ? OR "
+            "node_id NOT IN (SELECT node_id FROM nodes WHERE last_seen >= ?))", (NODE_ID, time.time() - NODE_TIMEOUT))
+        for (job_id,) in rows:
+            await self.db.execute('UPDATE broadcast_jobs SET node_id = ? WHERE job_id = ?', (NODE_ID, job_id))
+            logger.info(f"Resuming broadcast job {job_id}")
+            self.start_job(job_id)
+
+    async def stop(self):
+        tasks = [job['task'] for job in self.jobs.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _send(self, user_id, text):
+        for attempt in range(BROADCAST_MAX_RETRIES):
+            await self.limiter.acquire()
+            try:
+                await bot.send_message(user_id, f"📢 <b>Announcement:</b>\n\n{text}", parse_mode="HTML")
+                return True
+            except TelegramRetryAfter as e:
+                logger.warning(f"Broadcast rate limited, pausing for {e.retry_after}s")
+                self.limiter.pause(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                logger.info(f"Broadcast to {user_id} rejected: {e}")
+                return False
+            except Exception as e:
+                logger.warning(f"Broadcast to {user_id} failed (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(min(BROADCAST_BACKOFF_BASE * (2 ** attempt), 60))
+        return False
+
+    async def _report(self, job_id, job, final=False):
+        done = job['sent'] + job['failed']
+        percent = done * 100 // job['total'] if job['total'] else 100
+        if final:
+            text = (f"✅ <b>Broadcast Complete!</b>\n\n"
+                    f"✅ Sent: {job['sent']}\n"
+                    f"❌ Failed: {job['failed']}")
+        else:
+            text = (f"📢 <b>Broadcasting...</b> (job #{job_id})\n\n"
+                    f"✅ Sent: {job['sent']}\n"
+                    f"❌ Failed: {job['failed']}\n"
+                    f"📊 Progress: {done}/{job['total']} ({percent}%)")
+        if text == job.get('last_report'):
+            return
+        try:
+            await self.limiter.acquire()
+            await bot.edit_message_text(text, chat_id=job['chat_id'], message_id=job['message_id'], parse_mode="HTML")
+            job['last_report'] = text
+        except Exception as e:
+            logger.warning(f"Could not update broadcast status for job {job_id}: {e}")
+
+    async def _flush_results(self, job_id, job):
+        results, job['results'] = job['results'], []
+        if results:
+            await self.db.run(_save_broadcast_results, job_id, results, job['sent'], job['failed'])
+
+    async def _run_job(self, job_id):
+        job = self.jobs[job_id]
+        row = await self.db.fetchone(
+            'SELECT text, chat_id, message_id, total, sent, failed FROM broadcast_jobs WHERE job_id = ?', (job_id,))
+        if row is None:
+            self.jobs.pop(job_id, None)
+            return
+        text, job['chat_id'], job['message_id'], job['total'], job['sent'], job['failed'] = row
+        job['results'] = []
+        queue = asyncio.Queue(maxsize=self.concurrency * 4)
+
+        async def sender():
+            while True:
+                user_id = await queue.get()
+                try:
+                    if user_id in banned_users:
+                        delivered = False
+                    else:
+                        delivered = await self._send(user_id, text)
+                    job['sent' if delivered else 'failed'] += 1
+                    job['results'].append(('sent' if delivered else 'failed', job_id, user_id))
+                    if len(job['results']) >= BROADCAST_SAVE_BATCH:
+                        await self._flush_results(job_id, job)
+                finally:
+                    queue.task_done()
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+                await self._flush_results(job_id, job)
+                await self._report(job_id, job)
+
+        senders = [asyncio.create_task(sender()) for _ in range(self.concurrency)]
+        progress = asyncio.create_task(reporter())
+        try:
+            last_user_id = None
+            while True:
+                batch = await self.db.run(_pending_broadcast_recipients, job_id, last_user_id, BROADCAST_PAGE_SIZE)
+                if not batch:
+                    break
+                for (user_id,) in batch:
+                    await queue.put(user_id)
+                last_user_id = batch[-1][0]
+            await queue.join()
+            await self._flush_results(job_id, job)
+            await self.db.execute("UPDATE broadcast_jobs SET status = 'done', finished_at = ? WHERE job_id = ?",
+                                  (datetime.now().isoformat(), job_id))
+            await self._report(job_id, job, final=True)
+        finally:
+            progress.cancel()
+            for task in senders:
+                task.cancel()
+            await asyncio.gather(progress, *senders, return_exceptions=True)
+            try:
+                await self._flush_results(job_id, job)
+            except Exception as e:
+                logger.error(f"Could not save broadcast progress for job {job_id}: {e}")
+            self.jobs.pop(job_id, None)
+
+def _create_broadcast_job(conn, text, created_by, chat_id, message_id, created_at):
+    with conn:
+        c = conn.execute('INSERT INTO broadcast_jobs (text, status, created_by, chat_id, message_id, total, sent, failed, created_at, node_id) '
+                         "VALUES (?, 'running', ?, ?, ?, 0, 0, 0, ?, ?)",
+                         (text, created_by, chat_id, message_id, created_at, NODE_ID))
+        job_id = c.lastrowid
+        conn.execute("INSERT INTO broadcast_recipients (job_id, user_id, status) "
+                     "SELECT ?, user_id, 'pending' FROM active_users "
+                     "WHERE user_id NOT IN (SELECT user_id FROM banned_users)", (job_id,))
+        total = conn.execute('SELECT COUNT(*) FROM broadcast_recipients WHERE job_id = ?', (job_id,)).fetchone()[0]
+        conn.execute('UPDATE broadcast_jobs SET total = ? WHERE job_id = ?', (total, job_id))
+    return job_id, total
+
+def _pending_broadcast_recipients(conn, job_id, after_user_id, limit):
+    if after_user_id is None:
+        return conn.execute("SELECT user_id FROM broadcast_recipients WHERE job_id = ? AND status = 'pending' "
+                            "ORDER BY user_id LIMIT ?", (job_id, limit)).fetchall()
+    return conn.execute("SELECT user_id FROM broadcast_recipients WHERE job_id = ? AND status = 'pending' "
+                        "AND user_id > ? ORDER BY user_id LIMIT ?", (job_id, after_user_id, limit)).fetchall()
+
+def _save_broadcast_results(conn, job_id, results, sent, failed):
+    with conn:
+        conn.executemany('UPDATE broadcast_recipients SET status = ? WHERE job_id = ? AND user_id = ?', results)
+        conn.execute('UPDATE broadcast_jobs SET sent = ?, failed = ? WHERE job_id = ?', (sent, failed, job_id))
+
+broadcasts = BroadcastEngine(db, telegram_limiter, BROADCAST_CONCURRENCY)
+
+worker_pool = ThreadPoolExecutor(max_workers=WORKER_POOL_SIZE, thread_name_prefix="worker")
+
+async def run_in_worker(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(worker_pool, fn, *args)
+
+def extract_zip_archive(zip_path, dest_folder, progress):
+    dest_root = Path(dest_folder).resolve()
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        members = [info for info in zip_ref.infolist() if not info.is_dir()]
+        if len(members) > ZIP_MAX_ENTRIES:
+            raise ValueError(f"Archive has too many entries ({len(members)} > {ZIP_MAX_ENTRIES})")
+        declared_size = sum(info.file_size for info in members)
+        if declared_size > ZIP_MAX_TOTAL_SIZE:
+            raise ValueError(f"Archive is too large when extracted ({declared_size / (1024**2):.1f} MB)")
+        for info in members:
+            if info.file_size > ZIP_RATIO_MIN_SIZE and (not info.compress_size or
+                                                        info.file_size / info.compress_size > ZIP_MAX_COMPRESSION_RATIO):
+                raise ValueError(f"Suspicious compression ratio for {info.filename}")
+        
+        progress['total'] = len(members)
+        progress['total_bytes'] = declared_size
+        written_bytes = 0
+        staging_root = Path(tempfile.mkdtemp(prefix='.extract-', dir=dest_root))
+        try:
+            staged = []
+            for index, info in enumerate(members, 1):
+                target = (dest_root / info.filename).resolve()
+                if dest_root not in target.parents or staging_root == target or staging_root in target.parents:
+                    raise ValueError(f"Unsafe path in archive: {info.filename}")
+                if target.is_dir() and not target.is_symlink():
+                    raise ValueError(f"Archive entry {info.filename} would replace a folder")
+                staging = staging_root / target.relative_to(dest_root)
+                staging.parent.mkdir(parents=True, exist_ok=True)
+                with zip_ref.open(info) as source, open(staging, 'wb') as output:
+                    while True:
+                        chunk = source.read(ZIP_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        written_bytes += len(chunk)
+                        if written_bytes > ZIP_MAX_TOTAL_SIZE:
+                            raise ValueError("Archive exceeds the extraction size limit")
+                        output.write(chunk)
+                staged.append((staging, target))
+                progress['done'] = index
+                progress['bytes'] = written_bytes
+            for staging, target in staged:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(staging, target)
+        finally:
+            shutil.rmtree(staging_root, ignore_errors=True)
+    return [info.filename for info in members]
+
+def scan_file(path):
+    digest = hashlib.sha256()
+    line_count = 0
+    last_chunk = b''
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BLOB_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            line_count += chunk.count(b'\n')
+            last_chunk = chunk
+    if last_chunk and not last_chunk.endswith(b'\n'):
+        line_count += 1
+    return digest.hexdigest(), line_count
+
+def file_metadata(path):
+    stat = os.stat(path)
+    digest, line_count = scan_file(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'digest': digest, 'lines': line_count}
+
+def blob_path(digest):
+    return BLOB_STORE_DIR / digest[:2] / digest
+
+def link_blob(digest, target):
+    temp_target = target.with_name(f".{target.name}.{os.getpid()}.{threading.get_ident()}.link")
+    try:
+        os.link(blob_path(digest), temp_target)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        shutil.copyfile(blob_path(digest), temp_target)
+    os.replace(temp_target, target)
+    return True
+
+def store_blob(temp_path, digest, target):
+    path = blob_path(digest)
+    path.parent.mkdir(exist_ok=True)
+    if not link_blob(digest, target):
+        os.replace(temp_path, target)
+        try:
+            os.link(target, path)
+        except FileExistsError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not add {target} to the blob store: {e}")
+    Path(temp_path).unlink(missing_ok=True)
+    return path
+
+def release_blob(digest):
+    if not digest:
+        return False
+    path = blob_path(digest)
+    try:
+        if path.stat().st_nlink <= 1:
+            path.unlink()
+            return True
+    except FileNotFoundError:
+        pass
+    return False
+
+def ingest_file(path):
+    digest, line_count = scan_file(path)
+    blob = blob_path(digest)
+    blob.parent.mkdir(exist_ok=True)
+    if not link_blob(digest, path):
+        try:
+            os.link(path, blob)
+        except FileExistsError:
+            link_blob(digest, path)
+        except OSError as e:
+            logger.warning(f"Could not add {path} to the blob store: {e}")
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'digest': digest, 'lines': line_count}
+
+def detach_blob_link(path):
+    path = Path(path)
+    try:
+        if path.is_symlink() or path.stat().st_nlink <= 1:
+            return False
+        temp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.detach")
+        shutil.copyfile(path, temp_path)
+        os.replace(temp_path, path)
+        return True
+    except OSError as e:
+        logger.warning(f"Could not detach {path} from the blob store: {e}")
+        return False
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def ingest_upload(temp_path, target, digest=None, line_count=None):
+    if digest is None:
+        digest, line_count = scan_file(temp_path)
+    fsync_path(temp_path)
+    blob = store_blob(temp_path, digest, target)
+    fsync_path(blob.parent)
+    fsync_path(target.parent)
+    stat = os.stat(target)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'digest': digest, 'lines': line_count}
+
+class UploadScheduler:
+    def __init__(self, max_concurrent, max_bytes):
+        self.max_concurrent = max_concurrent
+        self.max_bytes = max_bytes
+        self.active = 0
+        self.active_bytes = 0
+        self.inflight = {}
+        self.waiters = []
+        self._sequence = 0
+
+    def reserve(self, user_id, file_name, files, tier, limit):
+        pending = self.inflight.get(user_id, {})
+        if file_name in pending:
+            return f"⏳ <code>{file_name}</code> is already being uploaded!"
+        if len(pending) >= UPLOAD_USER_INFLIGHT[tier]:
+            return f"⏳ You already have {len(pending)} uploads in progress, please wait for them to finish!"
+        is_new = file_name not in files
+        used = len(files) + sum(pending.values())
+        if is_new and used >= limit:
+            return f"❌ Upload limit reached! ({used}/{limit})\n\n💎 Upgrade to premium for more space!"
+        self.inflight.setdefault(user_id, pending)[file_name] = is_new
+        return None
+
+    def unreserve(self, user_id, file_name):
+        pending = self.inflight.get(user_id)
+        if pending is not None:
+            pending.pop(file_name, None)
+            if not pending:
+                del self.inflight[user_id]
+
+    def _fits(self, size):
+        return self.active < self.max_concurrent and (self.active == 0 or self.active_bytes + size <= self.max_bytes)
+
+    def _take(self, size):
+        self.active += 1
+        self.active_bytes += size
+
+    def try_acquire(self, size):
+        size = min(size, self.max_bytes)
+        if not self.waiters and self._fits(size):
+            self._take(size)
+            return True
+        return False
+
+    async def acquire(self, tier, size):
+        size = min(size, self.max_bytes)
+        if self.try_acquire(size):
+            return
+        self._sequence += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (TIER_PRIORITY[tier], self._sequence, size, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(size)
+            raise
+
+    def release(self, size):
+        size = min(size, self.max_bytes)
+        self.active -= 1
+        self.active_bytes -= size
+        while self.waiters:
+            _, _, waiter_size, future = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+            if not self._fits(waiter_size):
+                break
+            heapq.heappop(self.waiters)
+            self._take(waiter_size)
+            future.set_result(None)
+
+uploads = UploadScheduler(UPLOAD_MAX_CONCURRENT, UPLOAD_MAX_INFLIGHT_BYTES)
+
+def write_upload_chunks(f, digest, chunks):
+    data = b''.join(chunks)
+    f.write(data)
+    digest.update(data)
+
+async def download_document(document, temp_path, progress):
+    file = await bot.get_file(document.file_id)
+    if bot.session.api.is_local:
+        await bot.download_file(file.file_path, destination=temp_path, timeout=UPLOAD_TIMEOUT)
+        return await run_in_worker(scan_file, temp_path)
+    digest = hashlib.sha256()
+    line_count = 0
+    last_chunk = b''
+    buffered, buffered_bytes = [], 0
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    f = await run_in_worker(open, temp_path, 'wb')
+    try:
+        async for chunk in bot.session.stream_content(url, timeout=UPLOAD_TIMEOUT, chunk_size=UPLOAD_CHUNK_SIZE):
+            buffered.append(chunk)
+            buffered_bytes += len(chunk)
+            line_count += chunk.count(b'\n')
+            last_chunk = chunk
+            progress['bytes'] += len(chunk)
+            if buffered_bytes >= UPLOAD_WRITE_BUFFER:
+                await run_in_worker(write_upload_chunks, f, digest, buffered)
+                buffered, buffered_bytes = [], 0
+        if buffered:
+            await run_in_worker(write_upload_chunks, f, digest, buffered)
+    finally:
+        await run_in_worker(f.close)
+    if last_chunk and not last_chunk.endswith(b'\n'):
+        line_count += 1
+    return digest.hexdigest(), line_count
+
+def ingest_extracted_files(folder, names):
+    metadata = {}
+    for name in names:
+        if Path(name).suffix.lower() in BLOB_DEDUP_SUFFIXES:
+            try:
+                metadata[name] = ingest_file(folder / name)
+            except OSError as e:
+                logger.warning(f"Could not deduplicate {name}: {e}")
+    return metadata
+
+def gc_blobs():
+    removed = 0
+    for shard in BLOB_STORE_DIR.iterdir():
+        if not shard.is_dir() or shard == BLOB_TMP_DIR:
+            continue
+        for blob in shard.iterdir():
+            try:
+                if blob.stat().st_nlink <= 1:
+                    blob.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    cutoff = time.time() - BLOB_GC_INTERVAL
+    for temp_file in BLOB_TMP_DIR.iterdir():
+        try:
+            if temp_file.stat().st_mtime < cutoff:
+                temp_file.unlink()
+        except FileNotFoundError:
+            pass
+    return removed
+
+def search_files(conn, query, mode, user_id, offset, limit):
+    needle = query.lower()
+    if mode == 'glob':
+        predicate, predicate_params = 'lower(f.file_name) GLOB ?', [needle]
+        literals = [part for part in re.split(r'\[[^\]]*\]|[*?]', needle) if len(part) >= 3]
+        head = re.split(r'\[|[*?]', needle, maxsplit=1)[0]
+    elif mode == 'prefix':
+        predicate, predicate_params = 'substr(lower(f.file_name), 1, ?) = ?', [len(needle), needle]
+        literals = [needle] if len(needle) >= 3 else []
+        head = needle
+    else:
+        predicate, predicate_params = 'instr(lower(f.file_name), ?) > 0', [needle]
+        literals = [needle] if len(needle) >= 3 else []
+        head = needle
+    
+    where, params = [], []
+    if literals and search_index_enabled and user_id is None:
+        source = 'file_search s JOIN user_files f ON f.rowid = s.rowid'
+        where.append('s.file_name MATCH ?')
+        params.append(' AND '.join('"' + part.replace('"', '""') + '"' for part in literals))
+    else:
+        source = 'user_files f'
+    where.append(predicate)
+    params += predicate_params
+    if user_id is not None:
+        where.append('f.user_id = ?')
+        params.append(user_id)
+    where_sql = ' AND '.join(where)
+    
+    total = conn.execute(f'SELECT COUNT(*) FROM {source} WHERE {where_sql}', params).fetchone()[0]
+    rows = conn.execute(
+        f'SELECT f.user_id, f.file_name, f.file_type FROM {source} WHERE {where_sql} '
+        'ORDER BY CASE WHEN lower(f.file_name) = ? THEN 0 WHEN substr(lower(f.file_name), 1, ?) = ? THEN 1 ELSE 2 END, '
+        'length(f.file_name), f.file_name LIMIT ? OFFSET ?',
+        params + [needle, len(head), head, limit, offset]
+    ).fetchall()
+    return total, rows
+
+def parse_search_query(raw_query):
+    if raw_query.startswith('^'):
+        return raw_query[1:], 'prefix'
+    if any(ch in raw_query for ch in '*?['):
+        return raw_query, 'glob'
+    return raw_query, 'substring'
+
+async def render_search_page(user_id, page):
+    session = search_sessions.get(user_id)
+    if session is None:
+        return None, None
+    started = time.perf_counter()
+    total, rows = await db.run(search_files, session['query'], session['mode'], session['scope'],
+                               page * SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    
+    if not total:
+        return f"🔍 No files found matching '<code>{session['raw']}</code>'", None
+    
+    pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    scope = "🌐 All users" if session['scope'] is None else "👤 My files"
+    text = f"🔍 <b>Search Results ({total}):</b>\n{scope} • {session['mode']} • {elapsed_ms:.1f} ms\n\n"
+    
+    for i, (owner_id, file_name, file_type) in enumerate(rows, page * SEARCH_PAGE_SIZE + 1):
+        icon = "🐍" if file_type == "py" else "🟨" if file_type == "js" else "📦"
+        text += f"{i}. {icon} <code>{file_name}</code>"
+        if session['scope'] is None:
+            text += f" — <code>{owner_id}</code>"
+        text += "\n"
+    
+    text += f"\n📄 Page {page + 1}/{pages}"
+    
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅️ Prev", callback_data=f"search_page:{page - 1}"))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton(text="Next ➡️", callback_data=f"search_page:{page + 1}"))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+    return text, keyboard
+
+async def run_blob_gc():
+    while True:
+        try:
+            removed = await run_in_worker(gc_blobs)
+            if removed:
+                logger.info(f"Blob GC removed {removed} unreferenced blobs")
+        except Exception as e:
+            logger.error(f"Blob GC failed: {e}")
+        try:
+            removed = await dependencies.collect_garbage()
+            if removed:
+                logger.info(f"Dependency GC removed {removed} unused environments")
+        except Exception as e:
+            logger.error(f"Dependency GC failed: {e}")
+        await asyncio.sleep(BLOB_GC_INTERVAL)
+
+REQUIREMENT_LINE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*\s*(\[[A-Za-z0-9._,\s-]+\])?\s*'
+                              r'([<>=!~]=?=?\s*[A-Za-z0-9.*+!_-]+\s*(,\s*[<>=!~]=?=?\s*[A-Za-z0-9.*+!_-]+\s*)*)?(;.*)?$')
+
+def parse_requirements(text):
+    requirements = set()
+    for line in text.splitlines():
+        line = line.split(' #', 1)[0].strip()
+        if not line or line.startswith('#'):
+            continue
+        if not REQUIREMENT_LINE.match(line):
+            raise ValueError(f"Unsupported requirement: {line[:60]}")
+        name, rest = re.match(r'^([A-Za-z0-9._-]+)(.*)$', line).groups()
+        version, _, marker = rest.partition(';')
+        requirement = re.sub(r'[-_.]+', '-', name).lower() + version.replace(' ', '')
+        if marker.strip():
+            requirement += '; ' + ' '.join(marker.split())
+        requirements.add(requirement)
+    return sorted(requirements)
+
+def parse_package_json(text):
+    package = json.loads(text)
+    dependencies = package.get('dependencies') or {}
+    if not isinstance(dependencies, dict):
+        raise ValueError("package.json dependencies must be an object")
+    return {str(name): str(version) for name, version in sorted(dependencies.items())}
+
+def find_dependency_manifests(folder, names):
+    manifests = []
+    for name in names:
+        path = Path(name)
+        if 'node_modules' in path.parts or path.name not in ('requirements.txt', 'package.json'):
+            continue
+        text = (folder / path).read_text(encoding='utf-8', errors='replace')
+        if path.name == 'requirements.txt':
+            kind, spec = 'python', parse_requirements(text)
+            key = f"{sys.version_info.major}.{sys.version_info.minor}\n" + "\n".join(spec)
+        else:
+            kind, spec = 'node', parse_package_json(text)
+            key = json.dumps(spec, sort_keys=True)
+        if spec:
+            manifests.append({
+                'kind': kind,
+                'spec': spec,
+                'env_hash': hashlib.sha256(f"{kind}\n{key}".encode()).hexdigest()[:32],
+                'project_dir': str(folder / path.parent)
+            })
+    return manifests
+
+def dependency_env_path(kind, env_hash):
+    return DEPS_DIR / kind / env_hash
+
+def project_env_link(kind, project_dir):
+    return Path(project_dir) / ('.venv' if kind == 'python' else 'node_modules')
+
+def has_own_env(kind, project_dir):
+    link = project_env_link(kind, project_dir)
+    return link.is_dir() and not link.is_symlink()
+
+def link_dependency_env(kind, env_hash, project_dir):
+    env_path = dependency_env_path(kind, env_hash)
+    link = project_env_link(kind, project_dir)
+    target = env_path if kind == 'python' else env_path / 'node_modules'
+    if has_own_env(kind, project_dir):
+        return False
+    if link.is_symlink() or link.is_file():
+        link.unlink()
+    link.symlink_to(target, target_is_directory=True)
+    return True
+
+def linked_env(kind, project_dir):
+    link = project_env_link(kind, project_dir)
+    if not link.is_symlink():
+        return None
+    target = Path(os.readlink(link))
+    return (target if kind == 'python' else target.parent).name
+
+def gc_dependency_envs(links, active):
+    referenced = set()
+    stale = []
+    for project_dir, kind, env_hash in links:
+        if linked_env(kind, project_dir) == env_hash:
+            referenced.add((kind, env_hash))
+        else:
+            stale.append((project_dir, kind))
+    removed = 0
+    cutoff = time.time() - DEPS_GC_GRACE
+    for kind in ('python', 'node'):
+        kind_dir = DEPS_DIR / kind
+        if not kind_dir.is_dir():
+            continue
+        for env_path in kind_dir.iterdir():
+            if (kind, env_path.name) in referenced:
+                continue
+            try:
+                if env_path.stat().st_mtime < cutoff and not active[(kind, env_path.name)]:
+                    shutil.rmtree(env_path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    return removed, stale
+
+class DependencyManager:
+    def __init__(self, database, concurrency):
+        self.db = database
+        self.builds = {}
+        self.active = Counter()
+        self.jobs = set()
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def is_ready(self, kind, env_hash):
+        return (dependency_env_path(kind, env_hash) / '.ready').exists()
+
+    def _build_commands(self, kind, env_path):
+        if kind == 'python':
+            pip = [str(env_path / 'bin' / 'python'), '-m', 'pip', 'install', '--no-input', '--disable-pip-version-check',
+                   '--only-binary=:all:', '--cache-dir', str(DEPS_PIP_CACHE), '--find-links', str(DEPS_WHEELHOUSE)]
+            if DEPS_OFFLINE:
+                pip.append('--no-index')
+            return [[sys.executable, '-m', 'venv', str(env_path)], pip + ['-r', 'requirements.txt']]
+        npm = ['npm', 'install', '--omit=dev', '--ignore-scripts', '--no-audit', '--no-fund', '--cache', str(DEPS_NPM_CACHE),
+               '--offline' if DEPS_OFFLINE else '--prefer-offline']
+        return [npm]
+
+    async def _build(self, kind, env_hash, spec):
+        env_path = dependency_env_path(kind, env_hash)
+        async with self._semaphore:
+            if self.is_ready(kind, env_hash):
+                return
+            if env_path.exists():
+                await run_in_worker(shutil.rmtree, env_path)
+            env_path.mkdir(parents=True)
+            if kind == 'python':
+                (env_path / 'requirements.txt').write_text("\n".join(spec) + "\n")
+            else:
+                (env_path / 'package.json').write_text(json.dumps({'name': f"env-{env_hash}", 'private': True,
+                                                                    'dependencies': spec}, indent=2))
+            logger.info(f"Building {kind} dependency environment {env_hash}")
+            with open(env_path / 'build.log', 'wb') as build_log:
+                for command in self._build_commands(kind, env_path):
+                    process = await asyncio.create_subprocess_exec(
+                        *command, cwd=str(env_path), stdin=asyncio.subprocess.DEVNULL,
+                        stdout=build_log, stderr=build_log
+                    )
+                    try:
+                        returncode = await asyncio.wait_for(process.wait(), DEPS_BUILD_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        process.kill()
+                        await process.wait()
+                        raise RuntimeError(f"{command[0]} timed out after {DEPS_BUILD_TIMEOUT}s")
+                    if returncode != 0:
+                        raise RuntimeError(f"{Path(command[0]).name} exited with code {returncode}")
+            (env_path / '.ready').touch()
+
+    async def ensure(self, kind, env_hash, spec):
+        if self.is_ready(kind, env_hash):
+            return
+        key = (kind, env_hash)
+        task = self.builds.get(key)
+        if task is None:
+            task = asyncio.create_task(self._build(kind, env_hash, spec))
+            self.builds[key] = task
+            task.add_done_callback(lambda _: self.builds.pop(key, None))
+        await asyncio.shield(task)
+
+    async def install(self, user_id, manifest):
+        kind, env_hash, project_dir = manifest['kind'], manifest['env_hash'], manifest['project_dir']
+        if await run_in_worker(has_own_env, kind, project_dir):
+            return False
+        key = (kind, env_hash)
+        self.active[key] += 1
+        try:
+            await self.ensure(kind, env_hash, manifest['spec'])
+            if not await run_in_worker(link_dependency_env, kind, env_hash, project_dir):
+                return False
+        finally:
+            self.active[key] -= 1
+            if not self.active[key]:
+                del self.active[key]
+        await self.db.execute('INSERT OR REPLACE INTO dependency_links (project_dir, kind, user_id, env_hash, linked_at) '
+                              'VALUES (?, ?, ?, ?, ?)', (project_dir, kind, user_id, env_hash, datetime.now().isoformat()))
+        return True
+
+    async def install_all(self, user_id, manifests, chat_id):
+        lines = []
+        for manifest in manifests:
+            label = 'requirements.txt' if manifest['kind'] == 'python' else 'package.json'
+            own = '.venv' if manifest['kind'] == 'python' else 'node_modules'
+            try:
+                if await self.install(user_id, manifest):
+                    lines.append(f"✅ {label}: {len(manifest['spec'])} packages ready")
+                else:
+                    lines.append(f"ℹ️ {label}: using your own {own}/, shared environment not linked")
+            except Exception as e:
+                logger.error(f"Dependency install {manifest['env_hash']} for {user_id} failed: {e}")
+                lines.append(f"❌ {label}: {html.escape(str(e))}")
+        try:
+            await telegram_limiter.acquire()
+            await bot.send_message(chat_id, "📦 <b>Dependencies</b>\n\n" + "\n".join(lines), parse_mode="HTML")
+        except Exception as e:
+            logger.warning(f"Could not report dependency install to {user_id}: {e}")
+
+    def schedule(self, user_id, manifests, chat_id):
+        task = asyncio.create_task(self.install_all(user_id, manifests, chat_id))
+        self.jobs.add(task)
+        task.add_done_callback(self.jobs.discard)
+
+    async def collect_garbage(self):
+        links = await self.db.fetchall('SELECT project_dir, kind, env_hash FROM dependency_links')
+        removed, stale = await run_in_worker(gc_dependency_envs, links, self.active)
+        if stale:
+            await self.db.executemany('DELETE FROM dependency_links WHERE project_dir = ? AND kind = ?', stale)
+        return removed
+
+dependencies = DependencyManager(db, DEPS_BUILD_CONCURRENCY)
+
+LOG_PUMP_SOURCE = '''
+import os, signal, sys
+signal.signal(signal.SIGINT, signal.SIG_IGN)
+signal.signal(signal.SIGTERM, signal.SIG_IGN)
+path, max_bytes, backups = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+
+def rotate():
+    for index in range(backups - 1, 0, -1):
+        if os.path.exists(f"{path}.{index}"):
+            os.replace(f"{path}.{index}", f"{path}.{index + 1}")
+    if backups:
+        os.replace(path, f"{path}.1")
+    return open(path, 'wb', buffering=0)
+
+out = open(path, 'ab', buffering=0)
+size = out.tell()
+while True:
+    try:
+        chunk = os.read(0, 65536)
+    except InterruptedError:
+        continue
+    if not chunk:
+        break
+    chunk = chunk[-max_bytes:]
+    if size and size + len(chunk) > max_bytes:
+        out.close()
+        out = rotate()
+        size = 0
+    out.write(chunk)
+    size += len(chunk)
+out.close()
+'''
+
+def script_log_path(user_folder, file_name):
+    return Path(user_folder) / f"{Path(file_name).stem}.log"
+
+def tail_file(path, line_count):
+    lines = []
+    for candidate in (path, path.with_name(path.name + '.1')):
+        try:
+            with open(candidate, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                position = f.tell()
+                data = b''
+                while position > 0 and data.count(b'\n') <= line_count - len(lines):
+                    read_size = min(LOG_TAIL_BLOCK_SIZE, position)
+                    position -= read_size
+                    f.seek(position)
+                    data = f.read(read_size) + data
+        except FileNotFoundError:
+            continue
+        chunk_lines = data.decode('utf-8', errors='replace').splitlines()
+        if position > 0:
+            chunk_lines = chunk_lines[1:]
+        lines = chunk_lines[-(line_count - len(lines)):] + lines
+        if len(lines) >= line_count:
+            break
+    return lines
+
+def script_rlimits(limits, file_type):
+    rlimits = []
+    if limits.get('cpu_seconds'):
+        rlimits.append((resource.RLIMIT_CPU, limits['cpu_seconds']))
+    if limits.get('memory_mb') and file_type != 'js':
+        rlimits.append((resource.RLIMIT_AS, limits['memory_mb'] * 1024 * 1024))
+    if limits.get('open_files'):
+        rlimits.append((resource.RLIMIT_NOFILE, limits['open_files']))
+    return rlimits
+
+def apply_script_priority(pid, limits):
+    try:
+        proc = psutil.Process(pid)
+        if limits.get('nice'):
+            proc.nice(limits['nice'])
+        if limits.get('ionice') is not None:
+            proc.ionice(limits['ionice'])
+    except (psutil.Error, OSError, ValueError):
+        pass
+
+def apply_script_limits(pid, limits, file_type):
+    try:
+        for limit_id, value in script_rlimits(limits, file_type):
+            soft, hard = resource.prlimit(pid, limit_id)
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard)
+            resource.prlimit(pid, limit_id, (value, value))
+    except (ProcessLookupError, OSError, ValueError):
+        pass
+    apply_script_priority(pid, limits)
+
+WARM_POOL_SOURCE = '''
+import importlib, json, os, selectors, signal, socket, struct, sys
+socket_path, preload = sys.argv[1], [name for name in sys.argv[2].split(',') if name]
+for name in preload:
+    try:
+        importlib.import_module(name)
+    except Exception:
+        pass
+with open('/proc/self/statm') as statm:
+    preloaded_bytes = int(statm.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_child(request, log_fd):
+    os.setsid()
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_fd, 0)
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    os.close(null_fd)
+    os.close(log_fd)
+    os.chdir(request['cwd'])
+    import resource
+    for limit_id, value in request['rlimits']:
+        if limit_id == resource.RLIMIT_AS:
+            value += preloaded_bytes
+        soft, hard = resource.getrlimit(limit_id)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(limit_id, (value, value))
+    import runpy, traceback
+    sys.argv = [request['path']]
+    sys.path[0] = os.path.dirname(request['path'])
+    code = 0
+    try:
+        runpy.run_path(request['path'], run_name='__main__')
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        if not isinstance(e.code, int) and e.code is not None:
+            print(e.code, file=sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except Exception:
+        pass
+    os._exit(code)
+
+if os.path.exists(socket_path):
+    os.unlink(socket_path)
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(socket_path)
+server.listen(64)
+selector = selectors.DefaultSelector()
+selector.register(server, selectors.EVENT_READ)
+selector.register(sys.stdin, selectors.EVENT_READ)
+children = {}
+while True:
+    for key, _ in selector.select(timeout=0.2):
+        if key.fileobj is sys.stdin:
+            if not os.read(0, 1024):
+                os.unlink(socket_path)
+                os._exit(0)
+            continue
+        conn, _ = server.accept()
+        peer_pid, _, _ = struct.unpack('3i', conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+        if peer_pid != os.getppid():
+            conn.close()
+            continue
+        try:
+            conn.settimeout(5)
+            message, fds, _, _ = socket.recv_fds(conn, 65536, 1)
+            request = json.loads(message)
+            pid = os.fork()
+            if pid == 0:
+                selector.close()
+                server.close()
+                conn.close()
+                for other in children.values():
+                    other.close()
+                run_child(request, fds[0])
+            os.close(fds[0])
+            conn.sendall(f"{pid}\\n".encode())
+            children[pid] = conn
+        except Exception as e:
+            try:
+                conn.sendall(f"error {e}\\n".encode())
+            except OSError:
+                pass
+            conn.close()
+    while children:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            break
+        conn = children.pop(pid, None)
+        if conn is not None:
+            try:
+                conn.sendall(f"exit {os.waitstatus_to_exitcode(status)}\\n".encode())
+            except OSError:
+                pass
+            conn.close()
+'''
+class ScriptProcess:
+    def __init__(self, pid, popen=None):
+        self.pid = pid
+        self.returncode = None
+        self.exited = False
+        self._popen = popen
+        self._proc = psutil.Process(pid) if popen is None else None
+        self._exit = asyncio.create_task(self._wait_exit())
+
+    @classmethod
+    def spawn(cls, command, **kwargs):
+        popen = subprocess.Popen(command, **kwargs)
+        return cls(popen.pid, popen)
+
+    @classmethod
+    def adopt(cls, pid):
+        return cls(pid)
+
+    def _running(self):
+        if self._popen is not None:
+            return self._popen.poll() is None
+        try:
+            return self._proc.is_running() and self._proc.status() != psutil.STATUS_ZOMBIE
+        except psutil.NoSuchProcess:
+            return False
+
+    async def _wait_exit(self):
+        loop = asyncio.get_running_loop()
+        try:
+            pidfd = os.pidfd_open(self.pid)
+        except (AttributeError, OSError):
+            pidfd = None
+        if pidfd is not None:
+            exited = loop.create_future()
+            loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+            try:
+                await exited
+            finally:
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+        while self._running():
+            await asyncio.sleep(1)
+        if self._popen is not None:
+            self.returncode = self._popen.wait()
+        self.exited = True
+        return self.returncode
+
+    async def wait(self):
+        return await asyncio.shield(self._exit)
+
+    def send_signal(self, sig):
+        if not self.exited:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+class WarmProcess:
+    def __init__(self, pid, sock, buffered=b''):
+        self.pid = pid
+        self.returncode = None
+        self.exited = False
+        self._sock = sock
+        self._exit = asyncio.create_task(self._read_exit(buffered))
+
+    async def _read_exit(self, data):
+        loop = asyncio.get_running_loop()
+        try:
+            while not data.endswith(b'\n'):
+                chunk = await loop.sock_recv(self._sock, 64)
+                if not chunk:
+                    break
+                data += chunk
+        except OSError:
+            pass
+        finally:
+            self._sock.close()
+        parts = data.split()
+        if len(parts) == 2 and parts[0] == b'exit':
+            self.returncode = int(parts[1])
+        else:
+            await self._poll_exit()
+        self.exited = True
+        return self.returncode
+
+    async def _poll_exit(self):
+        try:
+            proc = psutil.Process(self.pid)
+            while proc.is_running() and proc.status() != psutil.STATUS_ZOMBIE:
+                await asyncio.sleep(1)
+        except psutil.NoSuchProcess:
+            pass
+
+    async def wait(self):
+        return await asyncio.shield(self._exit)
+
+    def send_signal(self, sig):
+        if not self.exited:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+class WarmPool:
+    def __init__(self, socket_path, preload):
+        self.socket_path = socket_path
+        self.preload = preload
+        self.process = None
+        self._starting = None
+
+    def ready(self):
+        return self.process is not None and self.process.returncode is None and self.socket_path.exists()
+
+    def start(self):
+        if self._starting is None or self._starting.done():
+            self._starting = asyncio.create_task(self._start())
+
+    async def _start(self):
+        if self.process is not None and self.process.returncode is None:
+            return
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, '-c', WARM_POOL_SOURCE, str(self.socket_path), ','.join(self.preload),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+            start_new_session=True
+        )
+        logger.info(f"🔥 Warm pool started (PID {self.process.pid})")
+
+    async def stop(self):
+        if self._starting is not None:
+            await asyncio.gather(self._starting, return_exceptions=True)
+        if self.process is not None and self.process.returncode is None:
+            self.process.stdin.close()
+            try:
+                await asyncio.wait_for(self.process.wait(), 5)
+            except asyncio.TimeoutError:
+                self.process.kill()
+
+    async def spawn(self, file_path, cwd, log_fd, limits, file_type):
+        if not self.ready():
+            self.start()
+            return None
+        request = {
+            'path': str(file_path),
+            'cwd': str(cwd),
+            'rlimits': script_rlimits(limits, file_type)
+        }
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, str(self.socket_path))
+            socket.send_fds(sock, [json.dumps(request).encode()], [log_fd])
+            reply = b''
+            while b'\n' not in reply:
+                chunk = await asyncio.wait_for(loop.sock_recv(sock, 64), WARM_POOL_SPAWN_TIMEOUT)
+                if not chunk:
+                    raise ConnectionError("warm pool closed the connection")
+                reply += chunk
+            line, rest = reply.split(b'\n', 1)
+            if not line.isdigit():
+                raise RuntimeError(line.decode(errors='replace'))
+        except BaseException:
+            sock.close()
+            raise
+        apply_script_priority(int(line), limits)
+        return WarmProcess(int(line), sock, rest)
+
+warm_pool = WarmPool(WARM_POOL_SOCKET, WARM_POOL_PRELOAD)
+
+def signal_process_tree(pid, sig, extra=()):
+    try:
+        descendants = psutil.Process(pid).children(recursive=True)
+    except psutil.NoSuchProcess:
+        descendants = []
+    try:
+        if os.getpgid(pid) == pid:
+            os.killpg(pid, sig)
+        else:
+            os.kill(pid, sig)
+    except ProcessLookupError:
+        pass
+    targets = {proc.pid: proc for proc in list(extra) + descendants}
+    for proc in targets.values():
+        try:
+            if os.getpgid(proc.pid) != pid:
+                proc.send_signal(sig)
+        except (psutil.NoSuchProcess, ProcessLookupError):
+            pass
+    return list(targets.values())
+
+def wait_process_tree(procs, timeout):
+    gone, alive = psutil.wait_procs(procs, timeout=timeout)
+    return alive
+
+class ScriptSupervisor:
+    def __init__(self, database):
+        self.db = database
+        self.last_exit = {}
+        self.recent_exits = deque(maxlen=SCRIPT_HISTORY_SIZE)
+        self.pending_restarts = {}
+        self.failure_times = {}
+        self.restart_times = {}
+
+    def build_command(self, file_path, limits):
+        file_ext = file_path.suffix.lower()
+        if file_ext == '.py':
+            venv_python = file_path.parent / '.venv' / 'bin' / 'python'
+            if venv_python.exists():
+                return [str(venv_python), str(file_path)]
+            return [sys.executable, str(file_path)]
+        if file_ext == '.js':
+            if limits.get('memory_mb'):
+                return ['node', f"--max-old-space-size={limits['memory_mb']}", str(file_path)]
+            return ['node', str(file_path)]
+        return None
+
+    async def start(self, user_id, file_name, file_path, user_folder):
+        tier = await load_user_tier(user_id)
+        limits = SCRIPT_LIMITS[tier]
+        command = self.build_command(file_path, limits)
+        if command is None:
+            return None
+        script_key = f"{user_id}_{file_name}"
+        file_type = file_path.suffix.lower()[1:]
+        log_path = script_log_path(user_folder, file_name)
+        await run_in_worker(detach_blob_link, file_path)
+        read_fd, write_fd = os.pipe()
+        try:
+            pump = ScriptProcess.spawn(
+                [sys.executable, '-c', LOG_PUMP_SOURCE, str(log_path), str(LOG_MAX_BYTES), str(LOG_BACKUP_COUNT)],
+                stdin=read_fd,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True
+            )
+            started = time.perf_counter()
+            process = None
+            if WARM_POOL_ENABLED and file_type == 'py' and command[0] == sys.executable:
+                try:
+                    process = await warm_pool.spawn(file_path, user_folder, write_fd, limits, file_type)
+                except Exception as e:
+                    logger.warning(f"Warm pool spawn failed for {script_key}, falling back to cold start: {e}")
+            launch = 'warm' if process is not None else 'cold'
+            if process is None:
+                process = ScriptProcess.spawn(
+                    command,
+                    cwd=str(user_folder),
+                    stdin=subprocess.DEVNULL,
+                    stdout=write_fd,
+                    stderr=write_fd,
+                    start_new_session=True
+                )
+                apply_script_limits(process.pid, limits, file_type)
+            start_ms = (time.perf_counter() - started) * 1000
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+        info = {
+            'process': process,
+            'file_name': file_name,
+            'script_owner_id': user_id,
+            'start_time': datetime.now(),
+            'user_folder': str(user_folder),
+            'type': file_type,
+            'command': command,
+            'launch': launch,
+            'start_ms': start_ms,
+            'log_path': str(log_path),
+            'log_pump': pump,
+            'tier': tier,
+            'cpu_seconds': 0.0,
+            'peak_rss': 0,
+            'state': 'running'
+        }
+        try:
+            info['pid_create_time'] = psutil.Process(process.pid).create_time()
+        except psutil.NoSuchProcess:
+            info['pid_create_time'] = None
+        bot_scripts[script_key] = info
+        info['watcher'] = asyncio.create_task(self._watch(script_key, info))
+        try:
+            await self.db.execute(
+                'INSERT OR REPLACE INTO running_scripts (script_key, user_id, file_name, pid, pid_create_time, started_at, '
+                'command, user_folder, log_path, file_type, tier, launch, desired_state, node_id) '
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'running', ?)",
+                (script_key, user_id, file_name, process.pid, info['pid_create_time'], info['start_time'].isoformat(),
+                 json.dumps(command), str(user_folder), str(log_path), file_type, tier, launch, NODE_ID))
+        except Exception as e:
+            logger.error(f"Could not register {script_key} in the script registry: {e}")
+        return info
+
+    async def mark_stopping(self, script_key, info):
+        info['stopping'] = True
+        await self.db.execute("UPDATE running_scripts SET desired_state = 'stopped' WHERE script_key = ?", (script_key,))
+
+    async def stop(self, script_key, info, grace=STOP_GRACE_PERIOD):
+        await self.cancel_restart(script_key)
+        await self.mark_stopping(script_key, info)
+        process = info['process']
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + grace
+        descendants = await asyncio.to_thread(signal_process_tree, process.pid, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), grace)
+            exited = True
+        except asyncio.TimeoutError:
+            exited = False
+        alive = await asyncio.to_thread(wait_process_tree, descendants, max(0.0, deadline - loop.time()))
+        if not exited or alive:
+            logger.warning(f"{script_key} ignored SIGTERM for {grace}s, sending SIGKILL")
+            leftovers = await asyncio.to_thread(signal_process_tree, process.pid, signal.SIGKILL, alive)
+            await asyncio.to_thread(wait_process_tree, leftovers, grace)
+            try:
+                await asyncio.wait_for(process.wait(), grace)
+            except asyncio.TimeoutError:
+                logger.error(f"{script_key} (PID {process.pid}) survived SIGKILL")
+            return True
+        return False
+
+    async def stop_many(self, script_keys):
+        targets = [(key, bot_scripts[key]) for key in script_keys if key in bot_scripts]
+        results = await asyncio.gather(*(self.stop(key, info) for key, info in targets), return_exceptions=True)
+        for (key, _), result in zip(targets, results):
+            if isinstance(result, Exception):
+                logger.error(f"Could not stop {key}: {result}")
+        return len(targets)
+
+    async def stop_user(self, user_id):
+        for script_key in [key for key in self.pending_restarts if key.startswith(f"{user_id}_")]:
+            await self.cancel_restart(script_key)
+        for script_key in [key for key, entry in scheduler.queued.items() if entry['user_id'] == user_id]:
+            scheduler.cancel(script_key)
+        return await self.stop_many([key for key, info in bot_scripts.items() if info['script_owner_id'] == user_id])
+
+    async def stop_all(self):
+        for script_key in list(self.pending_restarts):
+            await self.cancel_restart(script_key)
+        for script_key in list(scheduler.queued):
+            scheduler.cancel(script_key)
+        return await self.stop_many(list(bot_scripts))
+
+    def _adopt(self, row):
+        (script_key, user_id, file_name, pid, pid_create_time, started_at, command,
+         user_folder, log_path, file_type, tier, launch, desired_state) = row
+        try:
+            proc = psutil.Process(pid)
+            if pid_create_time is None or abs(proc.create_time() - pid_create_time) > 1 or proc.status() == psutil.STATUS_ZOMBIE:
+                return None
+        except psutil.NoSuchProcess:
+            return None
+        info = {
+            'process': ScriptProcess.adopt(pid),
+            'file_name': file_name,
+            'script_owner_id': user_id,
+            'start_time': datetime.fromisoformat(started_at),
+            'user_folder': user_folder,
+            'type': file_type,
+            'command': json.loads(command),
+            'launch': 'adopted',
+            'start_ms': 0.0,
+            'log_path': log_path,
+            'log_pump': None,
+            'tier': tier,
+            'cpu_seconds': 0.0,
+            'peak_rss': 0,
+            'state': 'running',
+            'pid_create_time': pid_create_time
+        }
+        if desired_state == 'stopped':
+            info['stopping'] = True
+        bot_scripts[script_key] = info
+        info['watcher'] = asyncio.create_task(self._watch(script_key, info))
+        return info
+
+    async def restore(self):
+        rows = await self.db.fetchall(
+            'SELECT script_key, user_id, file_name, pid, pid_create_time, started_at, command, user_folder, '
+            'log_path, file_type, tier, launch, desired_state, node_id FROM running_scripts WHERE node_id IS NULL OR node_id = ? OR '
+            'node_id NOT IN (SELECT node_id FROM nodes WHERE last_seen >= ?)', (NODE_ID, time.time() - NODE_TIMEOUT))
+        adopted = restarted = forwarded = removed = 0
+        for row in rows:
+            script_key, user_id, file_name, user_folder, desired_state, node_id = row[0], row[1], row[2], row[7], row[12], row[13]
+            try:
+                if node_id not in (None, NODE_ID):
+                    if not await self.db.execute('DELETE FROM running_scripts WHERE script_key = ? AND node_id = ?',
+                                                 (script_key, node_id)):
+                        continue
+                    logger.info(f"Taking over {script_key} from dead node {node_id}")
+                else:
+                    info = self._adopt(row[:13])
+                    if info is not None:
+                        if info.get('stopping'):
+                            info['process'].terminate()
+                        adopted += 1
+                        continue
+                    await self.db.execute('DELETE FROM running_scripts WHERE script_key = ?', (script_key,))
+                file_path = Path(user_folder) / file_name
+                if desired_state == 'running' and user_id not in banned_users and file_path.exists():
+                    owner = await cluster.owner_of(user_id)
+                    if owner != NODE_ID:
+                        await cluster.publish('run', {'user_id': user_id, 'file_name': file_name}, target=owner)
+                        forwarded += 1
+                        continue
+                    status, _ = await scheduler.request(user_id, file_name, file_path, Path(user_folder))
+                    if status in ('started', 'queued'):
+                        restarted += 1
+                        continue
+                removed += 1
+            except Exception as e:
+                logger.error(f"Could not restore script {script_key}: {e}")
+        logger.info(f"Script registry restored: {adopted} adopted, {restarted} restarted, "
+                    f"{forwarded} forwarded, {removed} removed")
+
+    async def _watch(self, script_key, info):
+        returncode = await info['process'].wait()
+        ended = datetime.now()
+        runtime = (ended - info['start_time']).total_seconds()
+        if info.get('stopping'):
+            state = 'stopped'
+        elif returncode is None:
+            state = 'unknown'
+        elif returncode == 0:
+            state = 'exited'
+        else:
+            state = 'crashed'
+        info['state'] = state
+        if bot_scripts.get(script_key) is info:
+            del bot_scripts[script_key]
+        scheduler.wake()
+        if info.get('log_pump') is not None:
+            info['log_drain'] = asyncio.create_task(self._drain_log_pump(script_key, info['log_pump']))
+        
+        exit_info = {
+            'script_key': script_key,
+            'file_name': info['file_name'],
+            'user_id': info['script_owner_id'],
+            'pid': info['process'].pid,
+            'exit_code': returncode,
+            'state': state,
+            'runtime': runtime,
+            'cpu_seconds': info['cpu_seconds'],
+            'peak_rss': info['peak_rss'],
+            'ended_at': ended
+        }
+        self.last_exit[script_key] = exit_info
+        self.recent_exits.append(exit_info)
+        logger.info(f"Script {script_key} (PID {exit_info['pid']}) {state} with code {returncode} after {runtime:.0f}s")
+        
+        delay, reason = None, None
+        try:
+            row = await self.db.fetchone('SELECT policy, consecutive_failures FROM script_policies WHERE script_key = ?',
+                                         (script_key,))
+            policy, consecutive = row if row else ('never', 0)
+            delay, consecutive, reason = self._plan_restart(script_key, info['script_owner_id'], policy, consecutive,
+                                                            state, runtime)
+            exit_info['restart_in'] = delay
+            statements = [
+                ('INSERT INTO script_runs (script_key, user_id, file_name, pid, started_at, ended_at, exit_code, state, runtime, '
+                 'tier, cpu_seconds, peak_rss) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 (script_key, info['script_owner_id'], info['file_name'], exit_info['pid'],
+                  info['start_time'].isoformat(), ended.isoformat(), returncode, state, runtime,
+                  info['tier'], info['cpu_seconds'], info['peak_rss'])),
+                ('INSERT INTO script_usage (script_key, user_id, runs, total_cpu_seconds, total_runtime, peak_rss) '
+                 'VALUES (?, ?, 1, ?, ?, ?) ON CONFLICT(script_key) DO UPDATE SET '
+                 'runs = runs + 1, total_cpu_seconds = total_cpu_seconds + excluded.total_cpu_seconds, '
+                 'total_runtime = total_runtime + excluded.total_runtime, peak_rss = max(peak_rss, excluded.peak_rss)',
+                 (script_key, info['script_owner_id'], info['cpu_seconds'], runtime, info['peak_rss'])),
+                ('INSERT INTO script_policies (script_key, user_id, file_name, policy, failures, consecutive_failures, '
+                 'restarts, last_exit_code, last_exit_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(script_key) DO UPDATE SET '
+                 'failures = failures + excluded.failures, consecutive_failures = excluded.consecutive_failures, '
+                 'restarts = restarts + excluded.restarts, last_exit_code = excluded.last_exit_code, '
+                 'last_exit_at = excluded.last_exit_at',
+                 (script_key, info['script_owner_id'], info['file_name'], policy, int(state in ('crashed', 'unknown')), consecutive,
+                  int(delay is not None), returncode, ended.isoformat()))
+            ]
+            if delay is None:
+                statements.append(('DELETE FROM running_scripts WHERE script_key = ? AND pid = ?', (script_key, exit_info['pid'])))
+            await self.db.transaction(statements)
+        except Exception as e:
+            logger.error(f"Could not record exit of {script_key}: {e}")
+        
+        if delay is not None:
+            logger.info(f"Restarting {script_key} in {delay}s")
+            self.pending_restarts[script_key] = asyncio.create_task(self._restart_later(script_key, info, delay))
+        elif reason is not None:
+            await self._notify_restart_blocked(info, reason)
+
+    async def _drain_log_pump(self, script_key, pump):
+        try:
+            await asyncio.wait_for(pump.wait(), LOG_PUMP_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Log pump of {script_key} still held open by a leftover process, closing it")
+            pump.kill()
+            await pump.wait()
+
+    def _plan_restart(self, script_key, user_id, policy, consecutive, state, runtime):
+        # 'unknown' (adopted scripts, warm-pool children of a dead zygote) cannot be shown to have exited cleanly,
+        # so it counts as a failure: 'on-failure' restarts it and it feeds the crash-loop window.
+        failed = state in ('crashed', 'unknown')
+        if runtime >= RESTART_STABLE_SECONDS:
+            consecutive = 0
+        if failed:
+            consecutive += 1
+        if state == 'stopped' or policy == 'never' or (policy == 'on-failure' and not failed):
+            return None, consecutive, None
+        
+        now = time.monotonic()
+        failures = self.failure_times.setdefault(script_key, deque())
+        if failed:
+            failures.append(now)
+        while failures and now - failures[0] > CRASH_LOOP_WINDOW:
+            failures.popleft()
+        if len(failures) >= CRASH_LOOP_THRESHOLD:
+            failures.clear()
+            return None, consecutive, 'crash_loop'
+        
+        budget = self.restart_times.setdefault(user_id, deque())
+        while budget and now - budget[0] > 3600:
+            budget.popleft()
+        if len(budget) >= RESTART_BUDGET_PER_HOUR:
+            return None, consecutive, 'budget'
+        budget.append(now)
+        return min(RESTART_BACKOFF_BASE * 2 ** max(consecutive - 1, 0), RESTART_BACKOFF_MAX), consecutive, None
+
+    async def _restart_later(self, script_key, info, delay):
+        try:
+            await asyncio.sleep(delay)
+            if info.get('log_drain') is not None:
+                await info['log_drain']
+            user_id, file_name = info['script_owner_id'], info['file_name']
+            file_path = Path(info['user_folder']) / file_name
+            if script_key in bot_scripts:
+                return
+            if user_id in banned_users or not file_path.exists():
+                await self.db.execute('DELETE FROM running_scripts WHERE script_key = ?', (script_key,))
+                return
+            await scheduler.request(user_id, file_name, file_path, Path(info['user_folder']))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Auto-restart of {script_key} failed: {e}")
+        finally:
+            if self.pending_restarts.get(script_key) is asyncio.current_task():
+                del self.pending_restarts[script_key]
+
+    async def cancel_restart(self, script_key):
+        task = self.pending_restarts.pop(script_key, None)
+        if task is None:
+            return False
+        task.cancel()
+        if script_key not in bot_scripts:
+            await self.db.execute('DELETE FROM running_scripts WHERE script_key = ?', (script_key,))
+        return True
+
+    async def set_policy(self, user_id, file_name, policy):
+        script_key = f"{user_id}_{file_name}"
+        await self.db.execute(
+            'INSERT INTO script_policies (script_key, user_id, file_name, policy, failures, consecutive_failures, restarts) '
+            'VALUES (?, ?, ?, ?, 0, 0, 0) ON CONFLICT(script_key) DO UPDATE SET policy = excluded.policy',
+            (script_key, user_id, file_name, policy))
+        if policy == 'never':
+            await self.cancel_restart(script_key)
+
+    async def _notify_restart_blocked(self, info, reason):
+        if reason == 'crash_loop':
+            text = (f"🔁 <b>Crash loop detected</b>\n\n<code>{info['file_name']}</code> failed {CRASH_LOOP_THRESHOLD} times "
+                    f"within {CRASH_LOOP_WINDOW // 60} minutes, auto-restart is paused. Check the log and press Run when fixed.")
+        else:
+            text = (f"🔁 <b>Restart budget used up</b>\n\n<code>{info['file_name']}</code> was not restarted: "
+                    f"you reached {RESTART_BUDGET_PER_HOUR} automatic restarts this hour.")
+        try:
+            await telegram_limiter.acquire()
+            await bot.send_message(info['script_owner_id'], text, parse_mode="HTML")
+        except Exception as e:
+            logger.warning(f"Could not notify {info['script_owner_id']} about blocked restart: {e}")
+
+supervisor = ScriptSupervisor(db)
+
+class AdmissionScheduler:
+    def __init__(self, supervisor, max_running, tier_caps, recheck_interval):
+        self.supervisor = supervisor
+        self.max_running = max_running
+        self.tier_caps = tier_caps
+        self.recheck_interval = recheck_interval
+        self.queue = []
+        self.queued = {}
+        self._sequence = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def position(self, script_key):
+        entry = self.queued.get(script_key)
+        if entry is None:
+            return None
+        return 1 + sum(1 for other in self.queued.values() if other['order'] < entry['order'])
+
+    def user_load(self, user_id):
+        running = sum(1 for info in bot_scripts.values() if info['script_owner_id'] == user_id)
+        return running + sum(1 for entry in self.queued.values() if entry['user_id'] == user_id)
+
+    def _blocker(self, tier, tier_counts, available):
+        if len(bot_scripts) >= self.max_running:
+            return 'capacity'
+        cap = self.tier_caps.get(tier)
+        if cap is not None and tier_counts.get(tier, 0) >= cap:
+            return 'tier'
+        if available < script_memory_estimate(tier) + ADMISSION_MIN_AVAILABLE_MB * 1024 * 1024:
+            return 'capacity'
+        return None
+
+    async def request(self, user_id, file_name, file_path, user_folder, chat_id=None):
+        script_key = f"{user_id}_{file_name}"
+        if script_key in self.queued:
+            return 'queued', self.position(script_key)
+        tier = await load_user_tier(user_id)
+        max_scripts = SCRIPT_LIMITS[tier].get('max_scripts')
+        if max_scripts is not None and self.user_load(user_id) >= max_scripts:
+            return 'limit', max_scripts
+        if len(self.queue) >= ADMISSION_MAX_QUEUE:
+            return 'full', None
+        self._sequence += 1
+        entry = {
+            'order': (TIER_PRIORITY[tier], self._sequence),
+            'script_key': script_key,
+            'user_id': user_id,
+            'file_name': file_name,
+            'file_path': file_path,
+            'user_folder': user_folder,
+            'tier': tier,
+            'chat_id': chat_id,
+            'future': asyncio.get_running_loop().create_future()
+        }
+        heapq.heappush(self.queue, (entry['order'], script_key))
+        self.queued[script_key] = entry
+        await self.dispatch()
+        if entry['future'].done():
+            return 'started', entry['future'].result()
+        entry['waited'] = True
+        self._ensure_rechecks()
+        return 'queued', self.position(script_key)
+
+    def cancel(self, script_key):
+        entry = self.queued.pop(script_key, None)
+        if entry is None:
+            return False
+        entry['future'].cancel()
+        return True
+
+    def wake(self):
+        if self.queued:
+            asyncio.create_task(self.dispatch())
+
+    async def dispatch(self):
+        async with self._lock:
+            available = psutil.virtual_memory().available
+            tier_counts = {}
+            for info in bot_scripts.values():
+                tier_counts[info.get('tier')] = tier_counts.get(info.get('tier'), 0) + 1
+            skipped = []
+            while self.queue:
+                order, script_key = heapq.heappop(self.queue)
+                entry = self.queued.get(script_key)
+                if entry is None or entry['order'] != order:
+                    continue
+                blocker = self._blocker(entry['tier'], tier_counts, available)
+                if blocker is not None:
+                    skipped.append((order, script_key))
+                    if blocker == 'capacity':
+                        break
+                    continue
+                del self.queued[script_key]
+                try:
+                    info = None
+                    if script_key not in bot_scripts:
+                        info = await self.supervisor.start(entry['user_id'], entry['file_name'],
+                                                           entry['file_path'], entry['user_folder'])
+                    entry['future'].set_result(info)
+                except Exception as e:
+                    logger.error(f"Could not start queued script {script_key}: {e}")
+                    if entry.get('waited'):
+                        entry['future'].set_result(None)
+                        if entry['chat_id'] is not None:
+                            asyncio.create_task(notify_queued_failure(entry, e))
+                    else:
+                        entry['future'].set_exception(e)
+                    continue
+                if info is not None:
+                    available -= script_memory_estimate(entry['tier'])
+                    tier_counts[entry['tier']] = tier_counts.get(entry['tier'], 0) + 1
+                    bot_stats['total_runs'] = bot_stats.get('total_runs', 0) + 1
+                    write_behind.increment('total_runs')
+                    if entry.get('waited') and entry['chat_id'] is not None:
+                        asyncio.create_task(notify_queued_start(entry, info))
+            for item in skipped:
+                heapq.heappush(self.queue, item)
+
+    def _ensure_rechecks(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._recheck())
+
+    async def _recheck(self):
+        while self.queued:
+            await asyncio.sleep(self.recheck_interval)
+            try:
+                await self.dispatch()
+            except Exception as e:
+                logger.error(f"Admission recheck failed: {e}")
+
+def script_memory_estimate(tier):
+    return (SCRIPT_LIMITS[tier].get('memory_mb') or ADMISSION_DEFAULT_SCRIPT_MB) * 1024 * 1024
+
+async def notify_queued_start(entry, info):
+    try:
+        await telegram_limiter.acquire()
+        await bot.send_message(entry['chat_id'], f"▶️ Your queued script <code>{entry['file_name']}</code> has started! "
+                                                 f"(PID: {info['process'].pid})", parse_mode="HTML")
+    except Exception as e:
+        logger.warning(f"Could not notify {entry['user_id']} about queued start: {e}")
+
+async def notify_queued_failure(entry, error):
+    try:
+        await telegram_limiter.acquire()
+        await bot.send_message(entry['chat_id'], f"❌ Your queued script <code>{entry['file_name']}</code> failed to start: "
+                                                 f"{html.escape(str(error))}", parse_mode="HTML")
+    except Exception as e:
+        logger.warning(f"Could not notify {entry['user_id']} about queued start failure: {e}")
+
+scheduler = AdmissionScheduler(supervisor, ADMISSION_MAX_RUNNING, ADMISSION_TIER_CAPS, ADMISSION_RECHECK_INTERVAL)
+
+def log_size(path):
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
+
+def read_log_increment(path, offset, max_bytes):
+    try:
+        with open(path, 'rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size < offset:
+                offset = 0
+            start = max(offset, size - max_bytes)
+            f.seek(start)
+            data = f.read(size - start)
+    except FileNotFoundError:
+        return 0, []
+    lines = data.decode('utf-8', errors='replace').splitlines()
+    if start > offset and lines:
+        lines = lines[1:]
+    return size, lines
+
+class LiveTailManager:
+    def __init__(self, limiter, interval, line_count):
+        self.limiter = limiter
+        self.interval = interval
+        self.line_count = line_count
+        self.tails = {}
+
+    def start(self, chat_id, message_id, script_key, info):
+        key = (chat_id, message_id)
+        self.stop(chat_id, message_id)
+        if len(self.tails) >= LIVE_TAIL_MAX_ACTIVE:
+            return False
+        self.tails[key] = asyncio.create_task(self._run(key, script_key, info))
+        return True
+
+    def stop(self, chat_id, message_id):
+        task = self.tails.pop((chat_id, message_id), None)
+        if task is not None:
+            task.cancel()
+
+    async def stop_all(self):
+        tasks = list(self.tails.values())
+        self.tails.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _render(self, file_name, lines, running):
+        log_text = "\n".join(lines)[-LOG_VIEW_MAX_CHARS:] or "(no output yet)"
+        status = "📡 Live" if running else "⚪ Script ended"
+        return f"""
+📜 <b>LOG:</b> <code>{file_name}</code>
+{status} • last {len(lines)} lines
+
+<pre>{html.escape(log_text)}</pre>
+"""
 
-def migrate_db():
+    def _keyboard(self, file_name, running):
+        first_row = [InlineKeyboardButton(text="⏹️ Stop Live", callback_data=f"live_log_stop:{file_name}")] if running else \
+            [InlineKeyboardButton(text="📜 View Log", callback_data=f"view_log:{file_name}")]
+        return InlineKeyboardMarkup(inline_keyboard=[
+            first_row + [InlineKeyboardButton(text="ℹ️ File Info", callback_data=f"file_info:{file_name}")],
+            [InlineKeyboardButton(text="📁 My Files", callback_data="check_files"),
+             InlineKeyboardButton(text="🏠 Home", callback_data="back_to_main")]
+        ])
+
+    async def _edit(self, key, text, keyboard, wait):
+        if wait:
+            await self.limiter.acquire()
+        elif not self.limiter.try_acquire():
+            return False
+        try:
+            await bot.edit_message_text(text, chat_id=key[0], message_id=key[1], reply_markup=keyboard, parse_mode="HTML")
+        except TelegramRetryAfter as e:
+            self.limiter.pause(e.retry_after)
+            return False
+        except TelegramBadRequest as e:
+            if "not modified" not in str(e):
+                raise
+        return True
+
+    async def _run(self, key, script_key, info):
+        file_name = info['file_name']
+        log_path = Path(info['log_path'])
+        shown = None
+        try:
+            lines = deque(await run_in_worker(tail_file, log_path, self.line_count), maxlen=self.line_count)
+            offset = await run_in_worker(log_size, log_path)
+            while bot_scripts.get(script_key) is info:
+                if await run_in_worker(log_size, log_path) != offset:
+                    offset, new_lines = await run_in_worker(read_log_increment, log_path, offset, LOG_VIEW_MAX_CHARS * 2)
+                    lines.extend(new_lines)
+                text = self._render(file_name, lines, True)
+                if text != shown and await self._edit(key, text, self._keyboard(file_name, True), wait=False):
+                    shown = text
+                await asyncio.sleep(self.interval)
+            await asyncio.sleep(self.interval)
+            offset, new_lines = await run_in_worker(read_log_increment, log_path, offset, LOG_VIEW_MAX_CHARS * 2)
+            lines.extend(new_lines)
+            await self._edit(key, self._render(file_name, lines, False), self._keyboard(file_name, False), wait=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Live log for {script_key} stopped: {e}")
+        finally:
+            if self.tails.get(key) is asyncio.current_task():
+                del self.tails[key]
+
+live_tails = LiveTailManager(telegram_limiter, LIVE_TAIL_INTERVAL, LOG_TAIL_LINES)
+
+def latest_state_event(conn):
+    return conn.execute('SELECT COALESCE(MAX(event_id), 0) FROM state_events').fetchone()[0]
+
+def claim_user_placement(conn, user_id, node_id, alive_since):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute('SELECT p.node_id FROM user_placements p JOIN nodes n ON n.node_id = p.node_id '
+                           'WHERE p.user_id = ? AND n.last_seen >= ?', (user_id, alive_since)).fetchone()
+        if row is None:
+            row = conn.execute('SELECT n.node_id FROM nodes n LEFT JOIN user_placements p ON p.node_id = n.node_id '
+                               'WHERE n.last_seen >= ? GROUP BY n.node_id ORDER BY COUNT(p.user_id), n.node_id != ? LIMIT 1',
+                               (alive_since, node_id)).fetchone() or (node_id,)
+            conn.execute('INSERT OR REPLACE INTO user_placements (user_id, node_id, assigned_at) VALUES (?, ?, ?)',
+                         (user_id, row[0], datetime.now().isoformat()))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return row[0]
+
+def check_shared_storage(node_id, peers):
+    NODE_MARKERS_DIR.mkdir(exist_ok=True)
+    (NODE_MARKERS_DIR / node_id).write_text(datetime.now().isoformat())
+    return [peer for peer in peers if not (NODE_MARKERS_DIR / peer).exists()]
+
+class ClusterNode:
+    COMMANDS = {'run', 'stop', 'stop_user', 'stop_all'}
+
+    def __init__(self, database, node_id, sync_interval, heartbeat_interval, node_timeout):
+        self.db = database
+        self.node_id = node_id
+        self.sync_interval = sync_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.node_timeout = node_timeout
+        self.started_at = datetime.now().isoformat()
+        self.cursor = 0
+        self.peers = {}
+        self.remote_scripts = set()
+        self._counts_refreshed = time.monotonic()
+        self._commands = set()
+        self._task = None
+
+    async def publish(self, kind, payload=None, target=None):
+        try:
+            await self.db.execute('INSERT INTO state_events (origin, target, kind, payload, created_at) VALUES (?, ?, ?, ?, ?)',
+                                  (self.node_id, target, kind, json.dumps(payload or {}), time.time()))
+        except Exception as e:
+            logger.error(f"Could not publish {kind} event: {e}")
+
+    async def owner_of(self, user_id):
+        return await self.db.run(claim_user_placement, user_id, self.node_id, time.time() - self.node_timeout)
+
+    async def locate(self, script_key, user_id):
+        alive_since = time.time() - self.node_timeout
+        row = await self.db.fetchone("SELECT r.node_id FROM running_scripts r JOIN nodes n ON n.node_id = r.node_id "
+                                     "WHERE r.script_key = ? AND r.desired_state = 'running' AND n.last_seen >= ?",
+                                     (script_key, alive_since))
+        if row is None:
+            row = await self.db.fetchone('SELECT p.node_id FROM user_placements p JOIN nodes n ON n.node_id = p.node_id '
+                                         'WHERE p.user_id = ? AND n.last_seen >= ?', (user_id, alive_since))
+        return row[0] if row else self.node_id
+
+    def is_running(self, script_key):
+        return script_key in bot_scripts or script_key in self.remote_scripts
+
+    async def heartbeat(self):
+        now = time.time()
+        await self.db.execute(
+            'INSERT INTO nodes (node_id, host, pid, started_at, last_seen, scripts) VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(node_id) DO UPDATE SET host = excluded.host, pid = excluded.pid, started_at = excluded.started_at, '
+            'last_seen = excluded.last_seen, scripts = excluded.scripts',
+            (self.node_id, socket.gethostname(), os.getpid(), self.started_at, now, len(bot_scripts)))
+        self.peers = dict(await self.db.fetchall('SELECT node_id, scripts FROM nodes WHERE last_seen >= ? AND node_id != ?',
+                                                 (now - self.node_timeout, self.node_id)))
+        rows = await self.db.fetchall(
+            "SELECT script_key FROM running_scripts WHERE desired_state = 'running' AND node_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(self.peers)),)) if self.peers else []
+        self.remote_scripts = {script_key for (script_key,) in rows}
+        for stat_name, stat_value in await self.db.fetchall('SELECT stat_name, stat_value FROM bot_stats'):
+            bot_stats[stat_name] = stat_value + write_behind.pending(stat_name)
+        if self.peers and time.monotonic() - self._counts_refreshed >= GLOBAL_COUNTS_REFRESH_INTERVAL:
+            apply_global_counts(*await self.db.run(count_global_state))
+            self._counts_refreshed = time.monotonic()
+        await self.db.execute('DELETE FROM state_events WHERE created_at < ?', (now - STATE_EVENT_RETENTION,))
+
+    async def poll(self):
+        rows = await self.db.fetchall('SELECT event_id, origin, target, kind, payload FROM state_events '
+                                      'WHERE event_id > ? ORDER BY event_id LIMIT ?', (self.cursor, STATE_SYNC_BATCH))
+        for event_id, origin, target, kind, payload in rows:
+            self.cursor = event_id
+            if origin == self.node_id or target not in (None, self.node_id):
+                continue
+            handler = getattr(self, f"_on_{kind}", None)
+            if handler is None:
+                logger.warning(f"Ignoring unknown state event {kind} from {origin}")
+                continue
+            if kind in self.COMMANDS:
+                task = asyncio.create_task(self._command(kind, handler, json.loads(payload)))
+                self._commands.add(task)
+                task.add_done_callback(self._commands.discard)
+                continue
+            try:
+                await handler(json.loads(payload))
+            except Exception as e:
+                logger.error(f"Could not apply {kind} event from {origin}: {e}")
+        return len(rows)
+
+    async def _command(self, kind, handler, payload):
+        try:
+            await handler(payload)
+        except Exception as e:
+            logger.error(f"Could not execute {kind} command: {e}")
+
+    async def _notify(self, chat_id, text):
+        if chat_id is None:
+            return
+        try:
+            await telegram_limiter.acquire()
+            await bot.send_message(chat_id, text, parse_mode="HTML")
+        except Exception as e:
+            logger.warning(f"Could not notify chat {chat_id}: {e}")
+
+    async def _on_ban(self, payload):
+        banned_users.add(payload['user_id'])
+
+    async def _on_unban(self, payload):
+        banned_users.discard(payload['user_id'])
+
+    async def _on_admin_add(self, payload):
+        admin_ids.add(payload['user_id'])
+
+    async def _on_admin_remove(self, payload):
+        admin_ids.discard(payload['user_id'])
+
+    async def _on_subscription(self, payload):
+        set_user_subscription(payload['user_id'], datetime.fromisoformat(payload['expiry']))
+
+    async def _on_lock(self, payload):
+        global bot_locked
+        bot_locked = payload['locked']
+
+    async def _on_user(self, payload):
+        global active_user_count
+        active_user_count += 1
+
+    async def _on_files(self, payload):
+        user_id = payload['user_id']
+        if user_cache.peek(user_id) is not None:
+            files, favorites, _, _ = await self.db.run(load_user_state, user_id)
+            state = user_cache.peek(user_id)
+            if state is not None:
+                state.files.load(files, favorites)
+
+    async def _on_run(self, payload):
+        user_id, file_name, chat_id = payload['user_id'], payload['file_name'], payload.get('chat_id')
+        user_folder = UPLOAD_BOTS_DIR / str(user_id)
+        file_path = user_folder / file_name
+        if user_id in banned_users or not file_path.exists():
+            await self._notify(chat_id, f"❌ <code>{html.escape(file_name)}</code> could not be started: file not found!")
+            return
+        await supervisor.cancel_restart(f"{user_id}_{file_name}")
+        status, result = await scheduler.request(user_id, file_name, file_path, user_folder, chat_id)
+        if status == 'started' and result is not None:
+            await self._notify(chat_id, f"✅ <code>{html.escape(file_name)}</code> started on node <code>{self.node_id}</code> "
+                                        f"(PID: {result['process'].pid}, {result['start_ms']:.0f} ms {result['launch']} start)")
+        elif status == 'started':
+            await self._notify(chat_id, f"⚠️ <code>{html.escape(file_name)}</code> is already running!")
+        elif status == 'queued':
+            await self._notify(chat_id, f"⏳ Server is busy - <code>{html.escape(file_name)}</code> is queued at position {result}. "
+                                        f"It will start automatically.")
+        elif status == 'limit':
+            await self._notify(chat_id, f"⚠️ You can run at most {result} scripts at once on your plan!")
+        else:
+            await self._notify(chat_id, "⚠️ The server is at capacity and the run queue is full, try again later!")
+
+    async def _on_stop(self, payload):
+        script_key, chat_id = payload['script_key'], payload.get('chat_id')
+        info = bot_scripts.get(script_key)
+        if info is not None:
+            killed = await supervisor.stop(script_key, info)
+            await self._notify(chat_id, "✅ Script killed (ignored SIGTERM)!" if killed else "✅ Script stopped successfully!")
+        elif scheduler.cancel(script_key):
+            await self._notify(chat_id, "✅ Removed from the run queue!")
+        elif await supervisor.cancel_restart(script_key):
+            await self._notify(chat_id, "✅ Pending restart cancelled!")
+        else:
+            await self._notify(chat_id, "❌ Script not found or already stopped!")
+
+    async def _on_stop_user(self, payload):
+        stopped = await supervisor.stop_user(payload['user_id'])
+        if stopped:
+            await self._notify(payload.get('chat_id'), f"🛑 Stopped {stopped} script(s) on node <code>{self.node_id}</code>.")
+
+    async def _on_stop_all(self, payload):
+        stopped = await supervisor.stop_all()
+        if stopped:
+            await self._notify(payload.get('chat_id'), f"🛑 Stopped {stopped} script(s) on node <code>{self.node_id}</code>.")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        last_heartbeat = loop.time()
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                if loop.time() - last_heartbeat >= self.heartbeat_interval:
+                    await self.heartbeat()
+                    last_heartbeat = loop.time()
+                while await self.poll() >= STATE_SYNC_BATCH:
+                    pass
+            except Exception as e:
+                logger.error(f"State sync failed: {e}")
+
+    async def start(self):
+        row = await self.db.fetchone('SELECT host, pid FROM nodes WHERE node_id = ? AND last_seen >= ?',
+                                     (self.node_id, time.time() - self.node_timeout))
+        if row is not None and tuple(row) != (socket.gethostname(), os.getpid()):
+            logger.warning(f"Node id {self.node_id} was heartbeating from {row[0]} (PID {row[1]}) moments ago; "
+                           f"if that replica is still running, give each replica its own NODE_ID")
+        await self.heartbeat()
+        missing = await asyncio.to_thread(check_shared_storage, self.node_id, list(self.peers))
+        if missing:
+            raise RuntimeError(f"Nodes {', '.join(missing)} do not share {UPLOAD_BOTS_DIR} with this node; every replica "
+                               f"needs inf/ and upload_bots/ on the same shared disk")
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._commands):
+            task.cancel()
+
+cluster = ClusterNode(db, NODE_ID, STATE_SYNC_INTERVAL, NODE_HEARTBEAT_INTERVAL, NODE_TIMEOUT)
+
+def migrate_db(conn):
     logger.info("Running database migrations...")
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
         c = conn.cursor()
         
         c.execute("PRAGMA table_info(user_files)")
@@ -86,6 +2841,15 @@ def migrate_db():
             logger.info("Adding upload_date column to user_files table...")
             c.execute('ALTER TABLE user_files ADD COLUMN upload_date TEXT')
             logger.info("upload_date column added successfully.")
+        if 'digest' not in columns:
+            logger.info("Adding digest column to user_files table...")
+            c.execute('ALTER TABLE user_files ADD COLUMN digest TEXT')
+            logger.info("digest column added successfully.")
+        for column, column_type in (('size', 'INTEGER'), ('mtime', 'REAL'), ('line_count', 'INTEGER')):
+            if column not in columns:
+                logger.info(f"Adding {column} column to user_files table...")
+                c.execute(f'ALTER TABLE user_files ADD COLUMN {column} {column_type}')
+                logger.info(f"{column} column added successfully.")
         
         c.execute("PRAGMA table_info(active_users)")
         columns = [row[1] for row in c.fetchall()]
@@ -98,21 +2862,36 @@ def migrate_db():
             c.execute('ALTER TABLE active_users ADD COLUMN last_active TEXT')
             logger.info("last_active column added successfully.")
         
+        c.execute("PRAGMA table_info(script_runs)")
+        columns = [row[1] for row in c.fetchall()]
+        for column, column_type in (('tier', 'TEXT'), ('cpu_seconds', 'REAL'), ('peak_rss', 'INTEGER')):
+            if column not in columns:
+                logger.info(f"Adding {column} column to script_runs table...")
+                c.execute(f'ALTER TABLE script_runs ADD COLUMN {column} {column_type}')
+                logger.info(f"{column} column added successfully.")
+        
+        for table in ('running_scripts', 'broadcast_jobs'):
+            c.execute(f"PRAGMA table_info({table})")
+            columns = [row[1] for row in c.fetchall()]
+            if 'node_id' not in columns:
+                logger.info(f"Adding node_id column to {table} table...")
+                c.execute(f'ALTER TABLE {table} ADD COLUMN node_id TEXT')
+                logger.info("node_id column added successfully.")
+        
         conn.commit()
-        conn.close()
         logger.info("Database migrations completed successfully.")
     except Exception as e:
         logger.error(f"Database migration error: {e}", exc_info=True)
 
-def init_db():
+def init_db(conn):
     logger.info(f"Initializing database at: {DATABASE_PATH}")
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
         c = conn.cursor()
         c.execute('''CREATE TABLE IF NOT EXISTS subscriptions
                      (user_id INTEGER PRIMARY KEY, expiry TEXT)''')
         c.execute('''CREATE TABLE IF NOT EXISTS user_files
-                     (user_id INTEGER, file_name TEXT, file_type TEXT, upload_date TEXT,
+                     (user_id INTEGER, file_name TEXT, file_type TEXT, upload_date TEXT, digest TEXT,
+                      size INTEGER, mtime REAL, line_count INTEGER,
                       PRIMARY KEY (user_id, file_name))''')
         c.execute('''CREATE TABLE IF NOT EXISTS active_users
                      (user_id INTEGER PRIMARY KEY, join_date TEXT, last_active TEXT)''')
@@ -124,6 +2903,40 @@ def init_db():
                      (user_id INTEGER, file_name TEXT, PRIMARY KEY (user_id, file_name))''')
         c.execute('''CREATE TABLE IF NOT EXISTS bot_stats
                      (stat_name TEXT PRIMARY KEY, stat_value INTEGER)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS script_runs
+                     (run_id INTEGER PRIMARY KEY AUTOINCREMENT, script_key TEXT, user_id INTEGER, file_name TEXT,
+                      pid INTEGER, started_at TEXT, ended_at TEXT, exit_code INTEGER, state TEXT, runtime REAL,
+                      tier TEXT, cpu_seconds REAL, peak_rss INTEGER)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS script_usage
+                     (script_key TEXT PRIMARY KEY, user_id INTEGER, runs INTEGER, total_cpu_seconds REAL,
+                      total_runtime REAL, peak_rss INTEGER)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS broadcast_jobs
+                     (job_id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT, status TEXT, created_by INTEGER,
+                      chat_id INTEGER, message_id INTEGER, total INTEGER, sent INTEGER, failed INTEGER,
+                      created_at TEXT, finished_at TEXT, node_id TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS running_scripts
+                     (script_key TEXT PRIMARY KEY, user_id INTEGER, file_name TEXT, pid INTEGER, pid_create_time REAL,
+                      started_at TEXT, command TEXT, user_folder TEXT, log_path TEXT, file_type TEXT, tier TEXT,
+                      launch TEXT, desired_state TEXT, node_id TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS script_policies
+                     (script_key TEXT PRIMARY KEY, user_id INTEGER, file_name TEXT, policy TEXT, failures INTEGER,
+                      consecutive_failures INTEGER, restarts INTEGER, last_exit_code INTEGER, last_exit_at TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS dependency_links
+                     (project_dir TEXT, kind TEXT, user_id INTEGER, env_hash TEXT, linked_at TEXT,
+                      PRIMARY KEY (project_dir, kind))''')
+        c.execute('''CREATE TABLE IF NOT EXISTS nodes
+                     (node_id TEXT PRIMARY KEY, host TEXT, pid INTEGER, started_at TEXT, last_seen REAL,
+                      scripts INTEGER)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS user_placements
+                     (user_id INTEGER PRIMARY KEY, node_id TEXT, assigned_at TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS state_events
+                     (event_id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT, target TEXT, kind TEXT,
+                      payload TEXT, created_at REAL)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS settings
+                     (key TEXT PRIMARY KEY, value TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS broadcast_recipients
+                     (job_id INTEGER, user_id INTEGER, status TEXT,
+                      PRIMARY KEY (job_id, user_id))''')
         
         c.execute('INSERT OR IGNORE INTO admins (user_id) VALUES (?)', (OWNER_ID,))
         if ADMIN_ID != OWNER_ID:
@@ -133,62 +2946,127 @@ def init_db():
             c.execute('INSERT OR IGNORE INTO bot_stats (stat_name, stat_value) VALUES (?, 0)', (stat,))
         
         conn.commit()
-        conn.close()
         logger.info("Database initialized successfully.")
     except Exception as e:
         logger.error(f"Database initialization error: {e}", exc_info=True)
 
-def load_data():
+def init_search_index(conn):
+    global search_index_enabled
+    try:
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'file_search'").fetchone()
+        with conn:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS file_search USING fts5"
+                         "(file_name, content='user_files', content_rowid='rowid', tokenize='trigram')")
+            conn.execute('''CREATE TRIGGER IF NOT EXISTS user_files_search_insert AFTER INSERT ON user_files BEGIN
+                                INSERT INTO file_search (rowid, file_name) VALUES (new.rowid, new.file_name);
+                            END''')
+            conn.execute('''CREATE TRIGGER IF NOT EXISTS user_files_search_delete AFTER DELETE ON user_files BEGIN
+                                INSERT INTO file_search (file_search, rowid, file_name) VALUES ('delete', old.rowid, old.file_name);
+                            END''')
+            conn.execute('''CREATE TRIGGER IF NOT EXISTS user_files_search_update AFTER UPDATE OF file_name ON user_files BEGIN
+                                INSERT INTO file_search (file_search, rowid, file_name) VALUES ('delete', old.rowid, old.file_name);
+                                INSERT INTO file_search (rowid, file_name) VALUES (new.rowid, new.file_name);
+                            END''')
+            if not exists:
+                logger.info("Building file search index...")
+                conn.execute("INSERT INTO file_search (file_search) VALUES ('rebuild')")
+        search_index_enabled = True
+    except sqlite3.Error as e:
+        search_index_enabled = False
+        logger.warning(f"FTS5 trigram search unavailable, falling back to table scans: {e}")
+
+def init_file_counts(conn):
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'user_file_counts'").fetchone()
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS user_file_counts (user_id INTEGER PRIMARY KEY, files INTEGER)')
+        conn.execute('CREATE INDEX IF NOT EXISTS user_file_counts_files ON user_file_counts (files)')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS user_files_count_insert AFTER INSERT ON user_files BEGIN
+                            INSERT INTO user_file_counts (user_id, files) VALUES (new.user_id, 1)
+                                ON CONFLICT(user_id) DO UPDATE SET files = files + 1;
+                        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS user_files_count_delete AFTER DELETE ON user_files BEGIN
+                            UPDATE user_file_counts SET files = files - 1 WHERE user_id = old.user_id;
+                            DELETE FROM user_file_counts WHERE user_id = old.user_id AND files <= 0;
+                        END''')
+        if not exists:
+            logger.info("Building per-user file counts...")
+            conn.execute('INSERT INTO user_file_counts (user_id, files) SELECT user_id, COUNT(*) FROM user_files GROUP BY user_id')
+
+def count_global_state(conn):
+    return (conn.execute('SELECT file_type, COUNT(*) FROM user_files GROUP BY file_type').fetchall(),
+            conn.execute('SELECT COUNT(*) FROM favorites').fetchone()[0],
+            conn.execute('SELECT COUNT(*) FROM active_users').fetchone()[0])
+
+def apply_global_counts(type_counts, total_favorites, users):
+    global active_user_count
+    aggregates.reset(type_counts, total_favorites)
+    active_user_count = users
+
+def load_data(conn):
+    global bot_locked
     logger.info("Loading data from database...")
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
         c = conn.cursor()
         
         c.execute('SELECT user_id, expiry FROM subscriptions')
         for user_id, expiry in c.fetchall():
             try:
-                user_subscriptions[user_id] = {'expiry': datetime.fromisoformat(expiry)}
+                aggregates.set_subscription(user_id, datetime.fromisoformat(expiry))
             except ValueError:
                 logger.warning(f"Invalid expiry date for user {user_id}")
         
-        c.execute('SELECT user_id, file_name, file_type FROM user_files')
-        for user_id, file_name, file_type in c.fetchall():
-            if user_id not in user_files:
-                user_files[user_id] = []
-            user_files[user_id].append((file_name, file_type))
-        
-        c.execute('SELECT user_id FROM active_users')
-        active_users.update(user_id for (user_id,) in c.fetchall())
-        
         c.execute('SELECT user_id FROM admins')
         admin_ids.update(user_id for (user_id,) in c.fetchall())
         
         c.execute('SELECT user_id FROM banned_users')
         banned_users.update(user_id for (user_id,) in c.fetchall())
         
-        c.execute('SELECT user_id, file_name FROM favorites')
-        for user_id, file_name in c.fetchall():
-            if user_id not in user_favorites:
-                user_favorites[user_id] = []
-            user_favorites[user_id].append(file_name)
-        
         c.execute('SELECT stat_name, stat_value FROM bot_stats')
         for stat_name, stat_value in c.fetchall():
             bot_stats[stat_name] = stat_value
         
-        conn.close()
-        logger.info(f"Data loaded: {len(active_users)} users, {len(banned_users)} banned, {len(admin_ids)} admins.")
+        c.execute("SELECT value FROM settings WHERE key = 'bot_locked'")
+        row = c.fetchone()
+        bot_locked = bool(row and row[0] == '1')
+        
+        apply_global_counts(*count_global_state(conn))
+        
+        logger.info(f"Data loaded: {active_user_count} users, {len(banned_users)} banned, {len(admin_ids)} admins.")
     except Exception as e:
         logger.error(f"Error loading data: {e}", exc_info=True)
 
-init_db()
-migrate_db()
-load_data()
+db.call(init_db)
+db.call(migrate_db)
+db.call(init_search_index)
+db.call(init_file_counts)
+cluster.cursor = db.call(latest_state_event)
+db.call(load_data)
+
+def backup_database(conn, backup_path):
+    backup_conn = sqlite3.connect(backup_path)
+    try:
+        conn.backup(backup_conn)
+    finally:
+        backup_conn.close()
+
+def has_active_subscription(user_id):
+    expiry = get_subscription_expiry(user_id)
+    return expiry is not None and expiry > datetime.now()
+
+def get_user_tier(user_id):
+    if user_id in admin_ids: return 'admin'
+    if has_active_subscription(user_id):
+        return 'premium'
+    return 'free'
+
+async def load_user_tier(user_id):
+    await user_cache.ensure(user_id)
+    return get_user_tier(user_id)
 
 def get_user_file_limit(user_id):
     if user_id == OWNER_ID: return OWNER_LIMIT
     if user_id in admin_ids: return ADMIN_LIMIT
-    if user_id in user_subscriptions and user_subscriptions[user_id]['expiry'] > datetime.now():
+    if has_active_subscription(user_id):
         return SUBSCRIBED_USER_LIMIT
     return FREE_USER_LIMIT
 
@@ -247,24 +3125,22 @@ def get_admin_panel_keyboard():
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
+    global active_user_count
     user_id = message.from_user.id
     
     if user_id in banned_users:
         await message.answer("🚫 <b>You are banned from using this bot!</b>\n\nContact admin for more info.", parse_mode="HTML")
         return
     
-    active_users.add(user_id)
-    
-    try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        now = datetime.now().isoformat()
-        c.execute('INSERT OR REPLACE INTO active_users (user_id, join_date, last_active) VALUES (?, ?, ?)', 
-                  (user_id, now, now))
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.error(f"Error saving active user: {e}")
+    now = datetime.now().isoformat()
+    state = user_cache.get(user_id)
+    if not state.known:
+        state.known = True
+        if await db.execute('INSERT OR IGNORE INTO active_users (user_id, join_date, last_active) VALUES (?, ?, ?)',
+                            (user_id, now, now)):
+            active_user_count += 1
+            await cluster.publish('user', {'user_id': user_id})
+    write_behind.touch_user(user_id, now)
     
     welcome_text = f"""
 ╔═══════════════════════╗
@@ -275,7 +3151,7 @@ async def cmd_start(message: types.Message):
 
 🆔 <b>Your ID:</b> <code>{user_id}</code>
 📦 <b>Upload Limit:</b> {get_user_file_limit(user_id)} files
-💎 <b>Account:</b> {'Premium ✨' if user_id in user_subscriptions else 'Free 🆓'}
+💎 <b>Account:</b> {'Premium ✨' if get_subscription_expiry(user_id) is not None else 'Free 🆓'}
 
 ━━━━━━━━━━━━━━━━━━━━
 <b>🎯 FREE USER FEATURES:</b>
@@ -310,7 +3186,7 @@ async def callback_back_to_main(callback: types.CallbackQuery):
 
 👤 <b>User:</b> {callback.from_user.full_name}
 🆔 <b>ID:</b> <code>{user_id}</code>
-📦 <b>Files:</b> {len(user_files.get(user_id, []))}/{get_user_file_limit(user_id)}
+📦 <b>Files:</b> {len(get_user_index(user_id))}/{get_user_file_limit(user_id)}
 
 Use buttons below to navigate 👇
 """
@@ -325,7 +3201,7 @@ async def callback_upload_file(callback: types.CallbackQuery):
         await callback.answer("🔒 Bot is locked for maintenance!", show_alert=True)
         return
     
-    current_files = len(user_files.get(user_id, []))
+    current_files = len(get_user_index(user_id))
     limit = get_user_file_limit(user_id)
     
     upload_text = f"""
@@ -361,7 +3237,7 @@ async def callback_upload_file(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "check_files")
 async def callback_check_files(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    files = user_files.get(user_id, [])
+    files = get_user_index(user_id)
     
     if not files:
         text = """
@@ -385,11 +3261,12 @@ Upload your first file to get started! 🚀
 
 """
         buttons = []
-        for i, (file_name, file_type) in enumerate(files, 1):
-            icon = "🐍" if file_type == "py" else "🟨" if file_type == "js" else "📦"
+        for i, record in enumerate(files, 1):
+            file_name = record.name
+            icon = "🐍" if record.type == "py" else "🟨" if record.type == "js" else "📦"
             text += f"{i}. {icon} <code>{file_name}</code>\n"
             
-            is_favorite = file_name in user_favorites.get(user_id, [])
+            is_favorite = files.is_favorite(file_name)
             star = "⭐" if is_favorite else "☆"
             
             buttons.append([
@@ -401,6 +3278,9 @@ Upload your first file to get started! 🚀
                 InlineKeyboardButton(text=f"🗑️ Delete", callback_data=f"delete_file:{file_name}")
             ])
         
+        if any(info['script_owner_id'] == user_id for info in bot_scripts.values()) or \
+                any(key.startswith(f"{user_id}_") for key in cluster.remote_scripts):
+            buttons.append([InlineKeyboardButton(text="🛑 Stop All My Scripts", callback_data="stop_my_scripts")])
         buttons.append([InlineKeyboardButton(text="🏠 Main Menu", callback_data="back_to_main")])
         back_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     
@@ -410,7 +3290,7 @@ Upload your first file to get started! 🚀
 @dp.callback_query(F.data == "my_favorites")
 async def callback_my_favorites(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    favorites = user_favorites.get(user_id, [])
+    favorites = sorted(get_user_index(user_id).favorites)
     
     if not favorites:
         text = """
@@ -447,7 +3327,7 @@ Add files to favorites for quick access! 🚀
 @dp.callback_query(F.data == "search_files")
 async def callback_search_files(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    files = user_files.get(user_id, [])
+    files = get_user_index(user_id)
     
     text = f"""
 ╔═══════════════════════╗
@@ -457,13 +3337,15 @@ async def callback_search_files(callback: types.CallbackQuery):
 📊 <b>Total Files:</b> {len(files)}
 
 <b>File Types:</b>
-🐍 Python: {sum(1 for f in files if f[1] == 'py')}
-🟨 JavaScript: {sum(1 for f in files if f[1] == 'js')}
-📦 ZIP: {sum(1 for f in files if f[1] == 'zip')}
+🐍 Python: {files.count_type('py')}
+🟨 JavaScript: {files.count_type('js')}
+📦 ZIP: {files.count_type('zip')}
 
 ━━━━━━━━━━━━━━━━━━━━
 To search, use:
 <code>/search filename</code>
+<code>/search ^prefix</code>
+<code>/search *.py</code>
 """
     
     back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -491,6 +3373,8 @@ async def callback_bot_speed(callback: types.CallbackQuery):
         status = "🔴 Slow"
         emoji = "🐌"
     
+    snapshot = await get_metrics_snapshot()
+    
     text = f"""
 ╔═══════════════════════╗
     ⚡ <b>SPEED TEST</b> ⚡
@@ -500,8 +3384,8 @@ async def callback_bot_speed(callback: types.CallbackQuery):
 📊 <b>Status:</b> {status}
 
 🖥️ <b>Server Info:</b>
-• CPU: {psutil.cpu_percent()}%
-• Memory: {psutil.virtual_memory().percent}%
+• CPU: {snapshot['cpu']}%
+• Memory: {snapshot['memory_percent']}%
 • Uptime: Online ✅
 
 ✨ Bot is running smoothly!
@@ -518,10 +3402,11 @@ async def callback_bot_speed(callback: types.CallbackQuery):
 async def callback_statistics(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     
-    user_file_count = len(user_files.get(user_id, []))
-    user_fav_count = len(user_favorites.get(user_id, []))
+    files = get_user_index(user_id)
+    user_file_count = len(files)
+    user_fav_count = len(files.favorites)
     limit = get_user_file_limit(user_id)
-    is_premium = user_id in user_subscriptions
+    is_premium = get_subscription_expiry(user_id) is not None
     
     text = f"""
 ╔═══════════════════════╗
@@ -537,7 +3422,7 @@ async def callback_statistics(callback: types.CallbackQuery):
 📁 Total Files: {user_file_count}/{limit}
 ⭐ Favorites: {user_fav_count}
 💎 Account: {'Premium ✨' if is_premium else 'Free 🆓'}
-🚀 Running: {sum(1 for k in bot_scripts if k.startswith(f"{user_id}_"))}
+🚀 Running: {sum(1 for k in bot_scripts.keys() | cluster.remote_scripts if k.startswith(f"{user_id}_"))}
 
 ━━━━━━━━━━━━━━━━━━━━
 📈 <b>USAGE:</b>
@@ -551,8 +3436,8 @@ async def callback_statistics(callback: types.CallbackQuery):
     
     if user_id in admin_ids:
         text += f"\n━━━━━━━━━━━━━━━━━━━━\n👑 <b>ADMIN STATS:</b>\n"
-        text += f"👥 Total Users: {len(active_users)}\n"
-        text += f"📁 Total Files: {sum(len(files) for files in user_files.values())}\n"
+        text += f"👥 Total Users: {active_user_count}\n"
+        text += f"📁 Total Files: {aggregates.total_files}\n"
     
     back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🏠 Main Menu", callback_data="back_to_main")]
@@ -720,24 +3605,18 @@ async def callback_toggle_favorite(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     file_name = callback.data.split(":", 1)[1]
     
-    if user_id not in user_favorites:
-        user_favorites[user_id] = []
+    files = get_user_index(user_id)
     
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        
-        if file_name in user_favorites[user_id]:
-            user_favorites[user_id].remove(file_name)
-            c.execute('DELETE FROM favorites WHERE user_id = ? AND file_name = ?', (user_id, file_name))
+        if files.is_favorite(file_name):
+            files.remove_favorite(file_name)
+            await db.execute('DELETE FROM favorites WHERE user_id = ? AND file_name = ?', (user_id, file_name))
             await callback.answer("❌ Removed from favorites!", show_alert=True)
         else:
-            user_favorites[user_id].append(file_name)
-            c.execute('INSERT OR IGNORE INTO favorites (user_id, file_name) VALUES (?, ?)', (user_id, file_name))
+            files.add_favorite(file_name)
+            await db.execute('INSERT OR IGNORE INTO favorites (user_id, file_name) VALUES (?, ?)', (user_id, file_name))
             await callback.answer("⭐ Added to favorites!", show_alert=True)
-        
-        conn.commit()
-        conn.close()
+        await cluster.publish('files', {'user_id': user_id})
         
         await callback_check_files(callback)
         
@@ -753,16 +3632,46 @@ async def callback_file_info(callback: types.CallbackQuery):
     user_folder = UPLOAD_BOTS_DIR / str(user_id)
     file_path = user_folder / file_name
     
-    if not file_path.exists():
+    try:
+        stat = file_path.stat()
+    except FileNotFoundError:
         await callback.answer("❌ File not found!", show_alert=True)
         return
     
-    file_size = file_path.stat().st_size
+    files = get_user_index(user_id)
+    record = files.get(file_name)
+    if record and record.size == stat.st_size and record.mtime == stat.st_mtime and record.digest and record.lines is not None:
+        digest, line_count = record.digest, record.lines
+    else:
+        metadata = await run_in_worker(file_metadata, file_path)
+        digest, line_count = metadata['digest'], metadata['lines']
+        if record:
+            record.update_metadata(metadata)
+            await db.execute('UPDATE user_files SET size = ?, mtime = ?, digest = ?, line_count = ? WHERE user_id = ? AND file_name = ?',
+                             (metadata['size'], metadata['mtime'], digest, line_count, user_id, file_name))
+            await cluster.publish('files', {'user_id': user_id})
+    
+    file_size = stat.st_size
     file_size_mb = file_size / (1024 * 1024)
     file_ext = file_path.suffix
-    modified_time = datetime.fromtimestamp(file_path.stat().st_mtime)
+    modified_time = datetime.fromtimestamp(stat.st_mtime)
+    
+    is_favorite = files.is_favorite(file_name)
     
-    is_favorite = file_name in user_favorites.get(user_id, [])
+    script_key = f"{user_id}_{file_name}"
+    policy_row = await db.fetchone('SELECT policy, failures, restarts, last_exit_code FROM script_policies WHERE script_key = ?',
+                                   (script_key,))
+    policy, failures, restarts, last_exit_code = policy_row if policy_row else ('never', 0, 0, None)
+    if script_key in bot_scripts:
+        run_state = "🟢 Running"
+    elif script_key in cluster.remote_scripts:
+        run_state = "🟢 Running (other node)"
+    elif script_key in scheduler.queued:
+        run_state = f"⏳ Queued (position {scheduler.position(script_key)})"
+    elif script_key in supervisor.pending_restarts:
+        run_state = "⏳ Restarting soon"
+    else:
+        run_state = "⚪ Stopped"
     
     text = f"""
 ╔═══════════════════════╗
@@ -774,14 +3683,22 @@ async def callback_file_info(callback: types.CallbackQuery):
 📦 <b>Type:</b> {file_ext.upper()} File
 💾 <b>Size:</b> {file_size_mb:.2f} MB ({file_size} bytes)
 📅 <b>Modified:</b> {modified_time.strftime('%Y-%m-%d %H:%M')}
+📝 <b>Lines:</b> {line_count}
 ⭐ <b>Favorite:</b> {'Yes ✨' if is_favorite else 'No'}
 
-🔐 <b>MD5:</b> <code>{hashlib.md5(file_path.read_bytes()).hexdigest()[:16]}...</code>
+🔐 <b>SHA-256:</b> <code>{digest[:16]}...</code>
+
+🚦 <b>Status:</b> {run_state}
+🔁 <b>Restart Policy:</b> {policy}
+💥 <b>Failures:</b> {failures} • <b>Auto-restarts:</b> {restarts}
+🔚 <b>Last Exit Code:</b> {'-' if last_exit_code is None else last_exit_code}
 """
     
     back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="▶️ Run", callback_data=f"run_script:{file_name}"),
+         InlineKeyboardButton(text=f"🔁 {policy}", callback_data=f"restart_policy:{file_name}"),
          InlineKeyboardButton(text="🗑️ Delete", callback_data=f"delete_file:{file_name}")],
+        [InlineKeyboardButton(text="📜 View Log", callback_data=f"view_log:{file_name}")],
         [InlineKeyboardButton(text="📁 My Files", callback_data="check_files"),
          InlineKeyboardButton(text="🏠 Home", callback_data="back_to_main")]
     ])
@@ -809,112 +3726,136 @@ async def handle_document(message: types.Message):
         await message.answer("❌ Only .py, .js, and .zip files are supported!")
         return
     
-    current_files = len(user_files.get(user_id, []))
+    files = get_user_index(user_id)
     limit = get_user_file_limit(user_id)
+    tier = get_user_tier(user_id)
     
-    if current_files >= limit:
-        await message.answer(f"❌ Upload limit reached! ({current_files}/{limit})\n\n💎 Upgrade to premium for more space!")
+    error = uploads.reserve(user_id, file_name, files, tier, limit)
+    if error:
+        await message.answer(error, parse_mode="HTML")
         return
     
     user_folder = UPLOAD_BOTS_DIR / str(user_id)
     user_folder.mkdir(exist_ok=True)
     
     file_path = user_folder / file_name
+    file_size = document.file_size or 0
     
     try:
-        file_size_kb = document.file_size / 1024
-        
-        status_msg = await message.answer(
-            f"📤 <b>Preparing upload...</b>\n\n"
-            f"📄 File: <code>{file_name}</code>\n"
-            f"💾 Size: {file_size_kb:.2f} KB\n\n"
-            f"▓░░░░░░░░░ 0%",
-            parse_mode="HTML"
-        )
-        
-        await asyncio.sleep(0.3)
-        await status_msg.edit_text(
-            f"📥 <b>Downloading...</b>\n\n"
-            f"📄 File: <code>{file_name}</code>\n"
-            f"💾 Size: {file_size_kb:.2f} KB\n\n"
-            f"▓▓▓░░░░░░░ 30%",
-            parse_mode="HTML"
-        )
-        
-        await bot.download(document, destination=file_path)
-        
-        await status_msg.edit_text(
-            f"💾 <b>Saving to database...</b>\n\n"
-            f"📄 File: <code>{file_name}</code>\n"
-            f"💾 Size: {file_size_kb:.2f} KB\n\n"
-            f"▓▓▓▓▓▓▓░░░ 70%",
-            parse_mode="HTML"
-        )
-        
-        if user_id not in user_files:
-            user_files[user_id] = []
-        
-        user_files[user_id].append((file_name, file_ext[1:]))
-        
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        now = datetime.now().isoformat()
-        c.execute('INSERT OR REPLACE INTO user_files (user_id, file_name, file_type, upload_date) VALUES (?, ?, ?, ?)',
-                  (user_id, file_name, file_ext[1:], now))
-        c.execute('UPDATE bot_stats SET stat_value = stat_value + 1 WHERE stat_name = ?', ('total_uploads',))
-        conn.commit()
-        conn.close()
-        
-        bot_stats['total_uploads'] = bot_stats.get('total_uploads', 0) + 1
-        
-        await status_msg.edit_text(
-            f"✅ <b>Finalizing...</b>\n\n"
-            f"📄 File: <code>{file_name}</code>\n"
-            f"💾 Size: {file_size_kb:.2f} KB\n\n"
-            f"▓▓▓▓▓▓▓▓▓▓ 100%",
-            parse_mode="HTML"
-        )
-        
-        await asyncio.sleep(0.5)
-        
-        if file_ext == '.zip':
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="📦 Extract ZIP", callback_data=f"extract_zip:{file_name}"),
-                 InlineKeyboardButton(text="⭐ Add Favorite", callback_data=f"toggle_fav:{file_name}")],
-                [InlineKeyboardButton(text="ℹ️ File Info", callback_data=f"file_info:{file_name}"),
-                 InlineKeyboardButton(text="🗑️ Delete", callback_data=f"delete_file:{file_name}")],
-                [InlineKeyboardButton(text="📁 My Files", callback_data="check_files"),
-                 InlineKeyboardButton(text="🏠 Main Menu", callback_data="back_to_main")]
-            ])
+        status_msg = None
+        if not uploads.try_acquire(file_size):
+            status_msg = await message.answer(
+                f"⏳ <b>Waiting for a free upload slot...</b>\n\n📄 File: <code>{file_name}</code>",
+                parse_mode="HTML"
+            )
+            await uploads.acquire(tier, file_size)
+        try:
+            await receive_document(message, document, file_name, file_ext, file_path, files, limit, status_msg)
+        finally:
+            uploads.release(file_size)
+    except Exception as e:
+        logger.error(f"Error uploading file: {e}")
+        await message.answer(f"❌ Upload failed: {str(e)}")
+    finally:
+        uploads.unreserve(user_id, file_name)
+
+async def receive_document(message, document, file_name, file_ext, file_path, files, limit, status_msg):
+    user_id = message.from_user.id
+    file_size = document.file_size or 0
+    progress = {'bytes': 0}
+    reporter = None
+    
+    if file_size >= UPLOAD_PROGRESS_MIN_SIZE:
+        text = (f"📥 <b>Downloading...</b>\n\n"
+                f"📄 File: <code>{file_name}</code>\n"
+                f"💾 Size: {file_size / (1024**2):.1f} MB")
+        if status_msg is None:
+            status_msg = await message.answer(text, parse_mode="HTML")
         else:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="▶️ Run Now", callback_data=f"run_script:{file_name}"),
-                 InlineKeyboardButton(text="⭐ Add Favorite", callback_data=f"toggle_fav:{file_name}")],
-                [InlineKeyboardButton(text="ℹ️ File Info", callback_data=f"file_info:{file_name}"),
-                 InlineKeyboardButton(text="🗑️ Delete", callback_data=f"delete_file:{file_name}")],
-                [InlineKeyboardButton(text="📁 My Files", callback_data="check_files"),
-                 InlineKeyboardButton(text="🏠 Main Menu", callback_data="back_to_main")]
-            ])
+            await status_msg.edit_text(text, parse_mode="HTML")
         
-        await status_msg.edit_text(
-            f"""
+        async def report_progress():
+            last_text = None
+            while True:
+                await asyncio.sleep(UPLOAD_PROGRESS_INTERVAL)
+                percent = min(progress['bytes'] * 100 // file_size, 100)
+                filled = percent // 10
+                text = (f"📥 <b>Downloading...</b>\n\n"
+                        f"📄 File: <code>{file_name}</code>\n"
+                        f"💾 {progress['bytes'] / (1024**2):.1f}/{file_size / (1024**2):.1f} MB\n\n"
+                        f"{'▓' * filled}{'░' * (10 - filled)} {percent}%")
+                if text != last_text and telegram_limiter.try_acquire():
+                    try:
+                        await status_msg.edit_text(text, parse_mode="HTML")
+                        last_text = text
+                    except Exception as e:
+                        logger.warning(f"Could not update upload progress: {e}")
+        
+        reporter = asyncio.create_task(report_progress())
+    
+    fd, temp_name = tempfile.mkstemp(suffix='.part', dir=BLOB_TMP_DIR)
+    os.close(fd)
+    try:
+        try:
+            digest, line_count = await download_document(document, temp_name, progress)
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+        metadata = await run_in_worker(ingest_upload, temp_name, file_path, digest, line_count)
+    finally:
+        Path(temp_name).unlink(missing_ok=True)
+    
+    now = datetime.now().isoformat()
+    record = FileRecord(file_name, file_ext[1:], now)
+    record.update_metadata(metadata)
+    previous = files.add(record)
+    
+    await db.execute('INSERT OR REPLACE INTO user_files (user_id, file_name, file_type, upload_date, digest, size, mtime, line_count) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (user_id, file_name, file_ext[1:], now, metadata['digest'],
+                      metadata['size'], metadata['mtime'], metadata['lines']))
+    await cluster.publish('files', {'user_id': user_id})
+    if previous and previous.digest != record.digest:
+        await run_in_worker(release_blob, previous.digest)
+    
+    bot_stats['total_uploads'] = bot_stats.get('total_uploads', 0) + 1
+    write_behind.increment('total_uploads')
+    
+    if file_ext == '.zip':
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📦 Extract ZIP", callback_data=f"extract_zip:{file_name}"),
+             InlineKeyboardButton(text="⭐ Add Favorite", callback_data=f"toggle_fav:{file_name}")],
+            [InlineKeyboardButton(text="ℹ️ File Info", callback_data=f"file_info:{file_name}"),
+             InlineKeyboardButton(text="🗑️ Delete", callback_data=f"delete_file:{file_name}")],
+            [InlineKeyboardButton(text="📁 My Files", callback_data="check_files"),
+             InlineKeyboardButton(text="🏠 Main Menu", callback_data="back_to_main")]
+        ])
+    else:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="▶️ Run Now", callback_data=f"run_script:{file_name}"),
+             InlineKeyboardButton(text="⭐ Add Favorite", callback_data=f"toggle_fav:{file_name}")],
+            [InlineKeyboardButton(text="ℹ️ File Info", callback_data=f"file_info:{file_name}"),
+             InlineKeyboardButton(text="🗑️ Delete", callback_data=f"delete_file:{file_name}")],
+            [InlineKeyboardButton(text="📁 My Files", callback_data="check_files"),
+             InlineKeyboardButton(text="🏠 Main Menu", callback_data="back_to_main")]
+        ])
+    
+    success_text = f"""
 ╔═══════════════════════╗
     ✅ <b>UPLOAD SUCCESS!</b> ✅
 ╚═══════════════════════╝
 
 📄 <b>File:</b> <code>{file_name}</code>
 📦 <b>Type:</b> {file_ext[1:].upper()}
-💾 <b>Size:</b> {document.file_size / 1024:.2f} KB
-📊 <b>Usage:</b> {current_files + 1}/{limit}
+💾 <b>Size:</b> {metadata['size'] / 1024:.2f} KB
+📊 <b>Usage:</b> {len(files)}/{limit}
 
 🎉 File uploaded successfully!
-""",
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logger.error(f"Error uploading file: {e}")
-        await message.answer(f"❌ Upload failed: {str(e)}")
+"""
+    if status_msg is None:
+        await message.answer(success_text, reply_markup=keyboard, parse_mode="HTML")
+    else:
+        await status_msg.edit_text(success_text, reply_markup=keyboard, parse_mode="HTML")
 
 @dp.callback_query(F.data.startswith("run_script:"))
 async def callback_run_script(callback: types.CallbackQuery):
@@ -930,56 +3871,55 @@ async def callback_run_script(callback: types.CallbackQuery):
     
     script_key = f"{user_id}_{file_name}"
     
-    if script_key in bot_scripts:
+    if cluster.is_running(script_key):
         await callback.answer("⚠️ Script is already running!", show_alert=True)
         return
     
-    file_ext = file_path.suffix.lower()
+    if supervisor.build_command(file_path, {}) is None:
+        await callback.answer("❌ Cannot run this file type!", show_alert=True)
+        return
     
     try:
-        log_file_path = user_folder / f"{file_path.stem}.log"
-        log_file = open(log_file_path, 'w')
+        owner = await cluster.owner_of(user_id)
+        if owner != NODE_ID:
+            await cluster.publish('run', {'user_id': user_id, 'file_name': file_name, 'chat_id': callback.message.chat.id},
+                                  target=owner)
+            await callback.answer(f"📡 Your scripts run on node {owner} - start request sent!", show_alert=True)
+            return
         
-        if file_ext == '.py':
-            process = subprocess.Popen(
-                [sys.executable, str(file_path)],
-                cwd=str(user_folder),
-                stdout=log_file,
-                stderr=log_file
-            )
-        elif file_ext == '.js':
-            process = subprocess.Popen(
-                ['node', str(file_path)],
-                cwd=str(user_folder),
-                stdout=log_file,
-                stderr=log_file
-            )
-        else:
-            log_file.close()
-            await callback.answer("❌ Cannot run this file type!", show_alert=True)
+        await supervisor.cancel_restart(script_key)
+        status, result = await scheduler.request(user_id, file_name, file_path, user_folder, callback.message.chat.id)
+        
+        if status == 'limit':
+            await callback.answer(f"⚠️ You can run at most {result} scripts at once on your plan!", show_alert=True)
+            return
+        if status == 'full':
+            await callback.answer("⚠️ The server is at capacity and the run queue is full, try again later!", show_alert=True)
+            return
+        if status == 'queued':
+            await callback.answer(f"⏳ Server is busy - your script is queued at position {result}. "
+                                  f"It will start automatically.", show_alert=True)
+            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="❌ Leave Queue", callback_data=f"stop_script:{script_key}")],
+                [InlineKeyboardButton(text="📁 My Files", callback_data="check_files"),
+                 InlineKeyboardButton(text="🏠 Home", callback_data="back_to_main")]
+            ])
+            await callback.message.edit_reply_markup(reply_markup=keyboard)
             return
         
-        bot_scripts[script_key] = {
-            'process': process,
-            'file_name': file_name,
-            'script_owner_id': user_id,
-            'start_time': datetime.now(),
-            'user_folder': str(user_folder),
-            'type': file_ext[1:],
-            'log_file': log_file
-        }
+        info = result
+        if info is None:
+            await callback.answer("⚠️ Script is already running!", show_alert=True)
+            return
         
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        c.execute('UPDATE bot_stats SET stat_value = stat_value + 1 WHERE stat_name = ?', ('total_runs',))
-        conn.commit()
-        conn.close()
-        bot_stats['total_runs'] = bot_stats.get('total_runs', 0) + 1
+        process = info['process']
         
-        await callback.answer(f"✅ Script started! (PID: {process.pid})", show_alert=True)
+        await callback.answer(f"✅ Script started! (PID: {process.pid}, {info['start_ms']:.0f} ms {info['launch']} start)", show_alert=True)
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🛑 Stop Script", callback_data=f"stop_script:{script_key}")],
+            [InlineKeyboardButton(text="🛑 Stop Script", callback_data=f"stop_script:{script_key}"),
+             InlineKeyboardButton(text="📜 View Log", callback_data=f"view_log:{file_name}")],
+            [InlineKeyboardButton(text="📡 Live Log", callback_data=f"live_log:{file_name}")],
             [InlineKeyboardButton(text="📁 My Files", callback_data="check_files"),
              InlineKeyboardButton(text="🏠 Home", callback_data="back_to_main")]
         ])
@@ -994,29 +3934,33 @@ async def callback_run_script(callback: types.CallbackQuery):
 async def callback_stop_script(callback: types.CallbackQuery):
     script_key = callback.data.split(":", 1)[1]
     
+    if not script_key.startswith(f"{callback.from_user.id}_") and callback.from_user.id not in admin_ids:
+        await callback.answer("❌ This is not your script!", show_alert=True)
+        return
+    
     if script_key not in bot_scripts:
-        await callback.answer("❌ Script not found or already stopped!", show_alert=True)
+        node = await cluster.locate(script_key, int(script_key.split("_", 1)[0]))
+        if node != NODE_ID:
+            await cluster.publish('stop', {'script_key': script_key, 'chat_id': callback.message.chat.id}, target=node)
+            await callback.answer(f"📡 Stop request sent to node {node}!", show_alert=True)
+            return
+        if scheduler.cancel(script_key):
+            await callback.answer("✅ Removed from the run queue!", show_alert=True)
+        elif await supervisor.cancel_restart(script_key):
+            await callback.answer("✅ Pending restart cancelled!", show_alert=True)
+        else:
+            await callback.answer("❌ Script not found or already stopped!", show_alert=True)
+        return
+    
+    script_info = bot_scripts[script_key]
+    if script_info['script_owner_id'] != callback.from_user.id and callback.from_user.id not in admin_ids:
+        await callback.answer("❌ This is not your script!", show_alert=True)
         return
     
     try:
-        script_info = bot_scripts[script_key]
-        process = script_info['process']
-        log_file = script_info.get('log_file')
+        killed = await supervisor.stop(script_key, script_info)
         
-        if log_file and not log_file.closed:
-            log_file.close()
-        
-        parent = psutil.Process(process.pid)
-        children = parent.children(recursive=True)
-        
-        for child in children:
-            child.terminate()
-        
-        parent.terminate()
-        
-        del bot_scripts[script_key]
-        
-        await callback.answer("✅ Script stopped successfully!", show_alert=True)
+        await callback.answer("✅ Script killed (ignored SIGTERM)!" if killed else "✅ Script stopped successfully!", show_alert=True)
         
         if callback.from_user.id in admin_ids:
             await callback.message.edit_text("🛑 Script stopped!", parse_mode="HTML")
@@ -1027,6 +3971,111 @@ async def callback_stop_script(callback: types.CallbackQuery):
         logger.error(f"Error stopping script: {e}")
         await callback.answer(f"❌ Error: {str(e)}", show_alert=True)
 
+@dp.callback_query(F.data == "stop_my_scripts")
+async def callback_stop_my_scripts(callback: types.CallbackQuery):
+    try:
+        await callback.answer("⏳ Stopping your scripts...")
+        await cluster.publish('stop_user', {'user_id': callback.from_user.id, 'chat_id': callback.message.chat.id})
+        stopped = await supervisor.stop_user(callback.from_user.id)
+        await callback.message.answer(f"🛑 Stopped {stopped} script(s)." if not cluster.peers else
+                                      f"🛑 Stopped {stopped} script(s) on node <code>{NODE_ID}</code>.", parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Error stopping user scripts: {e}")
+        await callback.message.answer(f"❌ Error: {str(e)}")
+
+@dp.callback_query(F.data == "admin_stop_all_scripts")
+async def callback_admin_stop_all_scripts(callback: types.CallbackQuery):
+    if callback.from_user.id not in admin_ids:
+        await callback.answer("❌ Admin only!", show_alert=True)
+        return
+    
+    try:
+        await callback.answer("⏳ Stopping all scripts...")
+        await cluster.publish('stop_all', {'chat_id': callback.message.chat.id})
+        stopped = await supervisor.stop_all()
+        await callback.message.answer(f"🛑 Stopped {stopped} script(s)." if not cluster.peers else
+                                      f"🛑 Stopped {stopped} script(s) on node <code>{NODE_ID}</code>.", parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Error stopping all scripts: {e}")
+        await callback.message.answer(f"❌ Error: {str(e)}")
+
+@dp.callback_query(F.data.startswith("restart_policy:"))
+async def callback_restart_policy(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    file_name = callback.data.split(":", 1)[1]
+    
+    try:
+        row = await db.fetchone('SELECT policy FROM script_policies WHERE script_key = ?', (f"{user_id}_{file_name}",))
+        current = row[0] if row else 'never'
+        policy = RESTART_POLICIES[(RESTART_POLICIES.index(current) + 1) % len(RESTART_POLICIES)]
+        await supervisor.set_policy(user_id, file_name, policy)
+        await callback_file_info(callback)
+    except Exception as e:
+        logger.error(f"Error changing restart policy: {e}")
+        await callback.answer(f"❌ Error: {str(e)}", show_alert=True)
+
+@dp.callback_query(F.data.startswith("view_log:"))
+async def callback_view_log(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    file_name = callback.data.split(":", 1)[1]
+    
+    log_path = script_log_path(UPLOAD_BOTS_DIR / str(user_id), file_name)
+    
+    try:
+        lines = await run_in_worker(tail_file, log_path, LOG_TAIL_LINES)
+        
+        if not lines:
+            await callback.answer("📭 No log output yet!", show_alert=True)
+            return
+        
+        log_text = "\n".join(lines)[-LOG_VIEW_MAX_CHARS:]
+        script_key = f"{user_id}_{file_name}"
+        status = "🟢 Running" if cluster.is_running(script_key) else "⚪ Not running"
+        
+        text = f"""
+📜 <b>LOG:</b> <code>{file_name}</code>
+{status} • last {len(lines)} lines
+
+<pre>{html.escape(log_text)}</pre>
+"""
+        
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔄 Refresh", callback_data=f"view_log:{file_name}"),
+             InlineKeyboardButton(text="ℹ️ File Info", callback_data=f"file_info:{file_name}")],
+            *([[InlineKeyboardButton(text="📡 Live Log", callback_data=f"live_log:{file_name}")]] if script_key in bot_scripts else []),
+            [InlineKeyboardButton(text="📁 My Files", callback_data="check_files"),
+             InlineKeyboardButton(text="🏠 Home", callback_data="back_to_main")]
+        ])
+        
+        await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+        await callback.answer()
+        
+    except Exception as e:
+        logger.error(f"Error viewing log: {e}")
+        await callback.answer(f"❌ Error: {str(e)}", show_alert=True)
+
+@dp.callback_query(F.data.startswith("live_log:"))
+async def callback_live_log(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    file_name = callback.data.split(":", 1)[1]
+    script_key = f"{user_id}_{file_name}"
+    
+    info = bot_scripts.get(script_key)
+    if info is None:
+        await callback.answer("⚪ Script is not running!", show_alert=True)
+        return
+    
+    if not live_tails.start(callback.message.chat.id, callback.message.message_id, script_key, info):
+        await callback.answer("⚠️ Too many live logs open right now, try again later!", show_alert=True)
+        return
+    
+    await callback.answer("📡 Live log started!")
+
+@dp.callback_query(F.data.startswith("live_log_stop:"))
+async def callback_live_log_stop(callback: types.CallbackQuery):
+    live_tails.stop(callback.message.chat.id, callback.message.message_id)
+    await callback_view_log(callback)
+
 @dp.callback_query(F.data.startswith("extract_zip:"))
 async def callback_extract_zip(callback: types.CallbackQuery):
     user_id = callback.from_user.id
@@ -1056,13 +4105,37 @@ Please wait...
 """
         await callback.message.edit_text(status_text, parse_mode="HTML")
         
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(user_folder)
-            all_files = zip_ref.namelist()
+        progress = {'done': 0, 'total': 0, 'bytes': 0, 'total_bytes': 0}
+        
+        async def report_progress():
+            last_text = None
+            while True:
+                await asyncio.sleep(ZIP_PROGRESS_INTERVAL)
+                if not progress['total']:
+                    continue
+                percent = progress['done'] * 100 // progress['total']
+                text = (f"📦 <b>Extracting ZIP...</b>\n\n"
+                        f"📄 File: <code>{file_name}</code>\n"
+                        f"📊 Entries: {progress['done']}/{progress['total']} ({percent}%)\n"
+                        f"💾 Written: {progress['bytes'] / (1024**2):.1f}/{progress['total_bytes'] / (1024**2):.1f} MB")
+                if text != last_text and telegram_limiter.try_acquire():
+                    try:
+                        await callback.message.edit_text(text, parse_mode="HTML")
+                        last_text = text
+                    except Exception as e:
+                        logger.warning(f"Could not update extraction progress: {e}")
+        
+        reporter = asyncio.create_task(report_progress())
+        try:
+            all_files = await run_in_worker(extract_zip_archive, zip_path, user_folder, progress)
+        finally:
+            reporter.cancel()
+        
+        metadata = await run_in_worker(ingest_extracted_files, user_folder, all_files)
+        files = get_user_index(user_id)
         
         registered_files = []
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
+        statements = []
         now = datetime.now().isoformat()
         
         for extracted_file in all_files:
@@ -1075,26 +4148,42 @@ Please wait...
             if file_ext in ['.py', '.js']:
                 just_name = file_path.name
                 
-                if user_id not in user_files:
-                    user_files[user_id] = []
+                meta = metadata.get(extracted_file, {})
+                record = FileRecord(just_name, file_ext[1:], now)
+                record.update_metadata(meta)
+                files.add(record)
                 
-                user_files[user_id].append((just_name, file_ext[1:]))
-                
-                c.execute('INSERT OR REPLACE INTO user_files (user_id, file_name, file_type, upload_date) VALUES (?, ?, ?, ?)',
-                          (user_id, just_name, file_ext[1:], now))
+                statements.append(('INSERT OR REPLACE INTO user_files (user_id, file_name, file_type, upload_date, digest, size, mtime, line_count) '
+                                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (user_id, just_name, file_ext[1:], now, meta.get('digest'),
+                                    meta.get('size'), meta.get('mtime'), meta.get('lines'))))
                 
                 registered_files.append(just_name)
         
-        if user_id in user_files:
-            user_files[user_id] = [f for f in user_files[user_id] if f[0] != file_name]
+        try:
+            manifests = await run_in_worker(find_dependency_manifests, user_folder, all_files)
+            if manifests:
+                dependencies.schedule(user_id, manifests, callback.message.chat.id)
+                deps_text = "\n".join(
+                    f"  • {'requirements.txt' if m['kind'] == 'python' else 'package.json'}: {len(m['spec'])} packages "
+                    f"({'shared cache' if dependencies.is_ready(m['kind'], m['env_hash']) else 'installing...'})"
+                    for m in manifests)
+            else:
+                deps_text = "  <i>None found</i>"
+        except ValueError as e:
+            deps_text = f"  ❌ {html.escape(str(e))}"
         
-        c.execute('DELETE FROM user_files WHERE user_id = ? AND file_name = ?', (user_id, file_name))
-        c.execute('DELETE FROM favorites WHERE user_id = ? AND file_name = ?', (user_id, file_name))
-        conn.commit()
-        conn.close()
+        zip_record = files.remove(file_name)
+        
+        statements.append(('DELETE FROM user_files WHERE user_id = ? AND file_name = ?', (user_id, file_name)))
+        statements.append(('DELETE FROM favorites WHERE user_id = ? AND file_name = ?', (user_id, file_name)))
+        await db.transaction(statements)
+        await cluster.publish('files', {'user_id': user_id})
         
         if zip_path.exists():
             zip_path.unlink()
+        if zip_record and zip_record.digest:
+            await run_in_worker(release_blob, zip_record.digest)
         
         registered_text = "\n".join([f"  • <code>{f}</code>" for f in registered_files[:10]])
         if len(registered_files) > 10:
@@ -1102,7 +4191,7 @@ Please wait...
         elif len(registered_files) == 0:
             registered_text = "  <i>No .py or .js files found</i>"
         
-        current_count = len(user_files.get(user_id, []))
+        current_count = len(files)
         limit = get_user_file_limit(user_id)
         
         success_text = f"""
@@ -1118,6 +4207,9 @@ Please wait...
 <b>📋 Registered Files:</b>
 {registered_text}
 
+<b>📦 Dependencies:</b>
+{deps_text}
+
 📦 <b>Your Files:</b> {current_count}/{limit}
 
 ✨ Extraction completed successfully!
@@ -1133,6 +4225,8 @@ Please wait...
         
     except zipfile.BadZipFile:
         await callback.answer("❌ Corrupted ZIP file!", show_alert=True)
+    except ValueError as e:
+        await callback.answer(f"❌ {str(e)}", show_alert=True)
     except Exception as e:
         logger.error(f"Error extracting ZIP: {e}")
         await callback.answer(f"❌ Extraction failed: {str(e)}", show_alert=True)
@@ -1146,21 +4240,18 @@ async def callback_delete_file(callback: types.CallbackQuery):
     file_path = user_folder / file_name
     
     try:
+        record = get_user_index(user_id).remove(file_name)
+        
         if file_path.exists():
             file_path.unlink()
+        if record and record.digest:
+            await run_in_worker(release_blob, record.digest)
         
-        if user_id in user_files:
-            user_files[user_id] = [f for f in user_files[user_id] if f[0] != file_name]
-        
-        if file_name in user_favorites.get(user_id, []):
-            user_favorites[user_id].remove(file_name)
-        
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        c.execute('DELETE FROM user_files WHERE user_id = ? AND file_name = ?', (user_id, file_name))
-        c.execute('DELETE FROM favorites WHERE user_id = ? AND file_name = ?', (user_id, file_name))
-        conn.commit()
-        conn.close()
+        await db.transaction([
+            ('DELETE FROM user_files WHERE user_id = ? AND file_name = ?', (user_id, file_name)),
+            ('DELETE FROM favorites WHERE user_id = ? AND file_name = ?', (user_id, file_name))
+        ])
+        await cluster.publish('files', {'user_id': user_id})
         
         await callback.answer("✅ File deleted successfully!", show_alert=True)
         await callback_check_files(callback)
@@ -1175,20 +4266,21 @@ async def callback_admin_total_users(callback: types.CallbackQuery):
         await callback.answer("❌ Admin only!", show_alert=True)
         return
     
-    user_list = "\n".join([f"• <code>{uid}</code>" for uid in list(active_users)[:15]])
+    rows = await db.fetchall('SELECT user_id FROM active_users ORDER BY join_date DESC LIMIT 15')
+    user_list = "\n".join([f"• <code>{uid}</code>" for (uid,) in rows])
     text = f"""
 ╔═══════════════════════╗
     👥 <b>USER STATISTICS</b> 👥
 ╚═══════════════════════╝
 
-📊 <b>Total Users:</b> {len(active_users)}
+📊 <b>Total Users:</b> {active_user_count}
 🚫 <b>Banned:</b> {len(banned_users)}
-✅ <b>Active:</b> {len(active_users) - len(banned_users)}
+✅ <b>Active:</b> {active_user_count - len(banned_users)}
 
 <b>📝 Recent Users (15):</b>
 {user_list}
 
-{'...' if len(active_users) > 15 else ''}
+{'...' if active_user_count > 15 else ''}
 """
     
     back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -1204,10 +4296,10 @@ async def callback_admin_total_files(callback: types.CallbackQuery):
         await callback.answer("❌ Admin only!", show_alert=True)
         return
     
-    total_files = sum(len(files) for files in user_files.values())
-    py_files = sum(1 for files in user_files.values() for f in files if f[1] == 'py')
-    js_files = sum(1 for files in user_files.values() for f in files if f[1] == 'js')
-    zip_files = sum(1 for files in user_files.values() for f in files if f[1] == 'zip')
+    total_files = aggregates.total_files
+    py_files = aggregates.type_counts.get('py', 0)
+    js_files = aggregates.type_counts.get('js', 0)
+    zip_files = aggregates.type_counts.get('zip', 0)
     
     text = f"""
 ╔═══════════════════════╗
@@ -1224,9 +4316,8 @@ async def callback_admin_total_files(callback: types.CallbackQuery):
 <b>📈 Top Users:</b>
 """
     
-    top_users = sorted(user_files.items(), key=lambda x: len(x[1]), reverse=True)[:5]
-    for user_id, files in top_users:
-        text += f"• User <code>{user_id}</code>: {len(files)} files\n"
+    for user_id, file_count in await db.fetchall('SELECT user_id, files FROM user_file_counts ORDER BY files DESC LIMIT 5'):
+        text += f"• User <code>{user_id}</code>: {file_count} files\n"
     
     back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔙 Admin Panel", callback_data="admin_panel")]
@@ -1258,16 +4349,51 @@ async def callback_admin_running_scripts(callback: types.CallbackQuery):
 
 """
         buttons = []
+        policies = {row[0]: row[1:] for row in await db.fetchall(
+            'SELECT script_key, policy, failures, last_exit_code FROM script_policies WHERE script_key IN (SELECT value FROM json_each(?))',
+            (json.dumps(list(bot_scripts)),))}
         for script_key, info in bot_scripts.items():
             runtime = (datetime.now() - info['start_time']).total_seconds()
             text += f"🔸 <code>{info['file_name']}</code>\n"
             text += f"   PID: {info['process'].pid} | User: {info['script_owner_id']}\n"
-            text += f"   Runtime: {int(runtime)}s\n\n"
+            text += f"   State: {'🟡 stopping' if info.get('stopping') else '🟢 ' + info.get('state', 'running')} | Runtime: {int(runtime)}s\n"
+            stats = metrics.script_stats(script_key)
+            if stats:
+                text += f"   CPU: {stats['cpu']:.1f}% | RAM: {stats['rss'] / (1024**2):.1f} MB\n"
+            text += (f"   Tier: {info.get('tier', '-')} | CPU time: {info.get('cpu_seconds', 0):.1f}s | "
+                     f"Peak: {info.get('peak_rss', 0) / (1024**2):.1f} MB\n")
+            policy, failures, last_exit_code = policies.get(script_key, ('never', 0, None))
+            text += f"   Restart: {policy} | Failures: {failures} | Last exit: {'-' if last_exit_code is None else last_exit_code}\n"
+            text += "\n"
             buttons.append([InlineKeyboardButton(
                 text=f"🛑 Stop {info['file_name'][:15]}", 
                 callback_data=f"stop_script:{script_key}"
             )])
     
+    if cluster.peers:
+        text += f"<b>🖥 Nodes:</b> <code>{NODE_ID}</code> (this node, {len(bot_scripts)} running)\n"
+        for node, scripts in sorted(cluster.peers.items()):
+            text += f"   <code>{node}</code> ({scripts} running)\n"
+        text += "\n"
+    
+    if scheduler.queued:
+        text += f"<b>⏳ Run Queue ({len(scheduler.queued)}):</b>\n"
+        for entry in sorted(scheduler.queued.values(), key=lambda entry: entry['order'])[:5]:
+            text += f"   <code>{entry['file_name']}</code> ({entry['user_id']}, {entry['tier']})\n"
+        text += "\n"
+    
+    if supervisor.recent_exits:
+        text += "<b>🕘 Recent Exits:</b>\n"
+        for exit_info in list(supervisor.recent_exits)[-5:][::-1]:
+            icon = "🔴" if exit_info['state'] == 'crashed' else "⚪"
+            text += (f"{icon} <code>{exit_info['file_name']}</code> ({exit_info['user_id']}) "
+                     f"{exit_info['state']}, code {'?' if exit_info['exit_code'] is None else exit_info['exit_code']}, "
+                     f"{int(exit_info['runtime'])}s")
+            text += f", restart in {exit_info['restart_in']}s\n" if exit_info.get('restart_in') is not None else "\n"
+    
+    if bot_scripts:
+        buttons.append([InlineKeyboardButton(text="🛑 Stop All Scripts", callback_data="admin_stop_all_scripts")])
+    buttons.append([InlineKeyboardButton(text="🔄 Refresh", callback_data="admin_running_scripts")])
     buttons.append([InlineKeyboardButton(text="🔙 Admin Panel", callback_data="admin_panel")])
     back_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     
@@ -1280,7 +4406,7 @@ async def callback_admin_premium_users(callback: types.CallbackQuery):
         await callback.answer("❌ Admin only!", show_alert=True)
         return
     
-    premium_users = [(u, data) for u, data in user_subscriptions.items() if data['expiry'] > datetime.now()]
+    premium_users = aggregates.premium_users()
     
     if not premium_users:
         text = """
@@ -1297,8 +4423,8 @@ No active premium subscriptions.
 ╚═══════════════════════╝
 
 """
-        for user_id, data in premium_users:
-            expiry_date = data['expiry'].strftime('%Y-%m-%d')
+        for expiry, user_id in premium_users:
+            expiry_date = expiry.strftime('%Y-%m-%d')
             text += f"💎 User <code>{user_id}</code>\n   Expires: {expiry_date}\n\n"
     
     back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -1315,6 +4441,8 @@ async def callback_admin_analytics(callback: types.CallbackQuery):
         await callback.answer("❌ Admin only!", show_alert=True)
         return
     
+    premium_active, premium_expired = aggregates.premium_counts()
+    
     text = f"""
 ╔═══════════════════════╗
     📊 <b>BOT ANALYTICS</b> 📊
@@ -1325,19 +4453,24 @@ async def callback_admin_analytics(callback: types.CallbackQuery):
 📤 Total Uploads: {bot_stats.get('total_uploads', 0)}
 📥 Total Downloads: {bot_stats.get('total_downloads', 0)}
 ▶️ Script Runs: {bot_stats.get('total_runs', 0)}
-👥 Total Users: {len(active_users)}
-📁 Total Files: {sum(len(files) for files in user_files.values())}
+👥 Total Users: {active_user_count}
+📁 Total Files: {aggregates.total_files}
 🚀 Running Now: {len(bot_scripts)}
-⭐ Total Favorites: {sum(len(favs) for favs in user_favorites.values())}
+⭐ Total Favorites: {aggregates.total_favorites}
 
 <b>💎 PREMIUM:</b>
-Active: {len([u for u in user_subscriptions if user_subscriptions[u]['expiry'] > datetime.now()])}
-Expired: {len([u for u in user_subscriptions if user_subscriptions[u]['expiry'] <= datetime.now()])}
+Active: {premium_active}
+Expired: {premium_expired}
 
 <b>🛡️ SECURITY:</b>
 Banned Users: {len(banned_users)}
 Admins: {len(admin_ids)}
 Bot Status: {'🔒 Locked' if bot_locked else '✅ Active'}
+
+<b>🧠 USER CACHE:</b>
+Cached: {len(user_cache)}/{user_cache.capacity}
+Hit Rate: {user_cache.hit_rate:.1%} ({user_cache.hits} hits, {user_cache.misses} misses)
+Evictions: {user_cache.evictions}
 """
     
     back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -1353,9 +4486,10 @@ async def callback_admin_system_status(callback: types.CallbackQuery):
         await callback.answer("❌ Admin only!", show_alert=True)
         return
     
-    cpu = psutil.cpu_percent(interval=1)
-    memory = psutil.virtual_memory()
-    disk = psutil.disk_usage('/')
+    snapshot = await get_metrics_snapshot()
+    cpu = snapshot['cpu']
+    cpu_trend = " → ".join(f"{value:.0f}%" for value in metrics.trend('cpu'))
+    sampled_ago = (datetime.now() - snapshot['time']).total_seconds()
     
     text = f"""
 ╔═══════════════════════╗
@@ -1364,22 +4498,25 @@ async def callback_admin_system_status(callback: types.CallbackQuery):
 
 <b>💻 CPU:</b>
 Usage: {cpu}%
+Trend: {cpu_trend}
 {'🟢 Normal' if cpu < 70 else '🟡 High' if cpu < 90 else '🔴 Critical'}
 
 <b>🧠 MEMORY:</b>
-Used: {memory.percent}%
-Free: {memory.available / (1024**3):.1f} GB
-Total: {memory.total / (1024**3):.1f} GB
+Used: {snapshot['memory_percent']}%
+Free: {snapshot['memory_available'] / (1024**3):.1f} GB
+Total: {snapshot['memory_total'] / (1024**3):.1f} GB
 
 <b>💾 DISK:</b>
-Used: {disk.percent}%
-Free: {disk.free / (1024**3):.1f} GB
-Total: {disk.total / (1024**3):.1f} GB
+Used: {snapshot['disk_percent']}%
+Free: {snapshot['disk_free'] / (1024**3):.1f} GB
+Total: {snapshot['disk_total'] / (1024**3):.1f} GB
 
 <b>🤖 BOT STATUS:</b>
 Status: {'🔒 Locked' if bot_locked else '✅ Running'}
 Scripts: {len(bot_scripts)} active
 Uptime: ✅ Online
+
+<i>Sampled {sampled_ago:.0f}s ago</i>
 """
     
     back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -1512,6 +4649,8 @@ async def callback_lock_bot(callback: types.CallbackQuery):
     
     bot_locked = not bot_locked
     status = "🔒 LOCKED" if bot_locked else "🔓 UNLOCKED"
+    await db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('bot_locked', ?)", ('1' if bot_locked else '0',))
+    await cluster.publish('lock', {'locked': bot_locked})
     
     await callback.answer(f"Bot is now {status}!", show_alert=True)
     await callback_admin_panel(callback)
@@ -1529,7 +4668,7 @@ async def callback_broadcast(callback: types.CallbackQuery):
 
 Send a message to all users!
 
-<b>Total Recipients:</b> {len(active_users)}
+<b>Total Recipients:</b> {active_user_count}
 
 <b>Command:</b>
 <code>/broadcast Your message here</code>
@@ -1617,11 +4756,7 @@ async def callback_admin_backup_db(callback: types.CallbackQuery):
     try:
         backup_path = IROTECH_DIR / f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
         
-        conn = sqlite3.connect(DATABASE_PATH)
-        backup_conn = sqlite3.connect(backup_path)
-        conn.backup(backup_conn)
-        backup_conn.close()
-        conn.close()
+        await db.run(backup_database, backup_path)
         
         await callback.answer("✅ Database backed up!", show_alert=True)
         
@@ -1715,11 +4850,8 @@ async def cmd_add_admin(message: types.Message):
         
         admin_ids.add(new_admin_id)
         
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        c.execute('INSERT OR IGNORE INTO admins (user_id) VALUES (?)', (new_admin_id,))
-        conn.commit()
-        conn.close()
+        await db.execute('INSERT OR IGNORE INTO admins (user_id) VALUES (?)', (new_admin_id,))
+        await cluster.publish('admin_add', {'user_id': new_admin_id})
         
         await message.answer(f"✅ User <code>{new_admin_id}</code> added as admin!", parse_mode="HTML")
         
@@ -1753,11 +4885,8 @@ async def cmd_remove_admin(message: types.Message):
         
         admin_ids.remove(remove_admin_id)
         
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        c.execute('DELETE FROM admins WHERE user_id = ?', (remove_admin_id,))
-        conn.commit()
-        conn.close()
+        await db.execute('DELETE FROM admins WHERE user_id = ?', (remove_admin_id,))
+        await cluster.publish('admin_remove', {'user_id': remove_admin_id})
         
         await message.answer(f"✅ User <code>{remove_admin_id}</code> removed from admins!", parse_mode="HTML")
         
@@ -1787,14 +4916,11 @@ async def cmd_add_premium(message: types.Message):
             return
         
         expiry = datetime.now() + timedelta(days=days)
-        user_subscriptions[user_id] = {'expiry': expiry}
+        set_user_subscription(user_id, expiry)
         
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        c.execute('INSERT OR REPLACE INTO subscriptions (user_id, expiry) VALUES (?, ?)',
-                  (user_id, expiry.isoformat()))
-        conn.commit()
-        conn.close()
+        await db.execute('INSERT OR REPLACE INTO subscriptions (user_id, expiry) VALUES (?, ?)',
+                         (user_id, expiry.isoformat()))
+        await cluster.publish('subscription', {'user_id': user_id, 'expiry': expiry.isoformat()})
         
         await message.answer(
             f"✅ <b>Premium Added!</b>\n\n"
@@ -1831,12 +4957,9 @@ async def cmd_ban_user(message: types.Message):
         
         banned_users.add(ban_user_id)
         
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        c.execute('INSERT OR REPLACE INTO banned_users (user_id, banned_date, reason) VALUES (?, ?, ?)',
-                  (ban_user_id, datetime.now().isoformat(), reason))
-        conn.commit()
-        conn.close()
+        await db.execute('INSERT OR REPLACE INTO banned_users (user_id, banned_date, reason) VALUES (?, ?, ?)',
+                         (ban_user_id, datetime.now().isoformat(), reason))
+        await cluster.publish('ban', {'user_id': ban_user_id})
         
         await message.answer(f"🚫 User <code>{ban_user_id}</code> has been banned!\n\nReason: {reason}", parse_mode="HTML")
         
@@ -1866,11 +4989,8 @@ async def cmd_unban_user(message: types.Message):
         
         banned_users.remove(unban_user_id)
         
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        c.execute('DELETE FROM banned_users WHERE user_id = ?', (unban_user_id,))
-        conn.commit()
-        conn.close()
+        await db.execute('DELETE FROM banned_users WHERE user_id = ?', (unban_user_id,))
+        await cluster.publish('unban', {'user_id': unban_user_id})
         
         await message.answer(f"✅ User <code>{unban_user_id}</code> has been unbanned!", parse_mode="HTML")
         
@@ -1893,29 +5013,19 @@ async def cmd_broadcast(message: types.Message):
             await message.answer("Usage: /broadcast Your message here")
             return
         
-        sent_count = 0
-        failed_count = 0
-        
-        status_msg = await message.answer(f"📢 Broadcasting to {len(active_users)} users...")
+        status_msg = await message.answer(f"📢 Broadcasting to {active_user_count} users...")
         
-        for user_id in active_users:
-            if user_id in banned_users:
-                continue
-            
-            try:
-                await bot.send_message(user_id, f"📢 <b>Announcement:</b>\n\n{broadcast_text}", parse_mode="HTML")
-                sent_count += 1
-                await asyncio.sleep(0.05)
-            except Exception as e:
-                logger.error(f"Failed to send to {user_id}: {e}")
-                failed_count += 1
+        job_id, total = await broadcasts.create_job(
+            broadcast_text, message.from_user.id, status_msg.chat.id, status_msg.message_id
+        )
         
         await status_msg.edit_text(
-            f"✅ <b>Broadcast Complete!</b>\n\n"
-            f"✅ Sent: {sent_count}\n"
-            f"❌ Failed: {failed_count}",
+            f"📢 <b>Broadcast queued!</b> (job #{job_id})\n\n"
+            f"👥 Recipients: {total}\n\n"
+            f"Progress will be updated here.",
             parse_mode="HTML"
         )
+        broadcasts.start_job(job_id)
         
     except Exception as e:
         logger.error(f"Error broadcasting: {e}")
@@ -1927,31 +5037,53 @@ async def cmd_search_files(message: types.Message):
     
     try:
         args = message.text.split(maxsplit=1)
-        if len(args) < 2:
-            await message.answer("Usage: /search filename")
-            return
-        
-        search_term = args[1].lower()
-        user_file_list = user_files.get(user_id, [])
+        raw_query = args[1].strip() if len(args) > 1 else ""
+        scope = user_id
         
-        matches = [f for f in user_file_list if search_term in f[0].lower()]
+        if raw_query.startswith("--all"):
+            if user_id not in admin_ids:
+                await message.answer("❌ Admin only!")
+                return
+            raw_query = raw_query[len("--all"):].strip()
+            scope = None
         
-        if not matches:
-            await message.answer(f"🔍 No files found matching '<code>{search_term}</code>'", parse_mode="HTML")
+        if not raw_query:
+            await message.answer("Usage: /search filename\n\n"
+                                 "• <code>^name</code> - prefix match\n"
+                                 "• <code>*.py</code> - glob pattern\n"
+                                 "• <code>/search --all name</code> - all users (admin)",
+                                 parse_mode="HTML")
             return
         
-        text = f"🔍 <b>Search Results ({len(matches)}):</b>\n\n"
+        query, mode = parse_search_query(raw_query)
+        search_sessions[user_id] = {'raw': raw_query, 'query': query, 'mode': mode, 'scope': scope}
         
-        for file_name, file_type in matches:
-            icon = "🐍" if file_type == "py" else "🟨" if file_type == "js" else "📦"
-            text += f"{icon} <code>{file_name}</code>\n"
-        
-        await message.answer(text, parse_mode="HTML")
+        text, keyboard = await render_search_page(user_id, 0)
+        await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
         
     except Exception as e:
         logger.error(f"Search error: {e}")
         await message.answer(f"❌ Error: {str(e)}")
 
+@dp.callback_query(F.data.startswith("search_page:"))
+async def callback_search_page(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    
+    try:
+        page = int(callback.data.split(":", 1)[1])
+        text, keyboard = await render_search_page(user_id, page)
+        
+        if text is None:
+            await callback.answer("❌ Search expired, run /search again!", show_alert=True)
+            return
+        
+        await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+        await callback.answer()
+        
+    except Exception as e:
+        logger.error(f"Search error: {e}")
+        await callback.answer(f"❌ Error: {str(e)}", show_alert=True)
+
 @dp.message(Command("help"))
 async def cmd_help(message: types.Message):
     text = """
@@ -2002,9 +5134,10 @@ async def cmd_help(message: types.Message):
 @dp.message(Command("stats"))
 async def cmd_stats(message: types.Message):
     user_id = message.from_user.id
-    user_file_count = len(user_files.get(user_id, []))
-    user_fav_count = len(user_favorites.get(user_id, []))
-    is_premium = user_id in user_subscriptions and user_subscriptions[user_id]['expiry'] > datetime.now()
+    files = get_user_index(user_id)
+    user_file_count = len(files)
+    user_fav_count = len(files.favorites)
+    is_premium = has_active_subscription(user_id)
     
     text = f"""
 ╔═══════════════════════╗
@@ -2018,7 +5151,7 @@ async def cmd_stats(message: types.Message):
 📦 Files Uploaded: {user_file_count}/{get_user_file_limit(user_id)}
 ⭐ Favorites: {user_fav_count}
 💎 Account: {'Premium ✨' if is_premium else 'Free 🆓'}
-🚀 Running: {sum(1 for k in bot_scripts if k.startswith(f"{user_id}_"))}
+🚀 Running: {sum(1 for k in bot_scripts.keys() | cluster.remote_scripts if k.startswith(f"{user_id}_"))}
 
 ━━━━━━━━━━━━━━━━━━━━
 📈 <b>USAGE:</b>
@@ -2032,8 +5165,8 @@ async def cmd_stats(message: types.Message):
     
     if user_id in admin_ids:
         text += f"\n━━━━━━━━━━━━━━━━━━━━\n👑 <b>ADMIN STATS:</b>\n"
-        text += f"👥 Total Users: {len(active_users)}\n"
-        text += f"📁 Total Files: {sum(len(files) for files in user_files.values())}\n"
+        text += f"👥 Total Users: {active_user_count}\n"
+        text += f"📁 Total Files: {aggregates.total_files}\n"
     
     back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🏠 Main Menu", callback_data="back_to_main")]
@@ -2049,18 +5182,58 @@ async def web_server():
     
     app.router.add_get('/', handle)
     
+    if WEBHOOK_URL:
+        BoundedRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+    
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', 5000)
+    site = web.TCPSite(runner, '0.0.0.0', WEB_SERVER_PORT)
     await site.start()
-    logger.info("🌐 Web server started on port 5000")
+    logger.info(f"🌐 Web server started on port {WEB_SERVER_PORT}")
+    return runner
 
 async def main():
     logger.info("🚀 Starting Advanced File Host Bot...")
     
-    asyncio.create_task(web_server())
-    
-    await dp.start_polling(bot)
+    write_behind.start()
+    metrics.start()
+    if WARM_POOL_ENABLED:
+        warm_pool.start()
+    await cluster.start()
+    logger.info(f"🖥 Node {NODE_ID} joined with {len(cluster.peers)} peer(s)")
+    await broadcasts.resume()
+    await supervisor.restore()
+    asyncio.create_task(run_blob_gc())
+    
+    runner = await web_server()
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            logger.info(f"📡 Webhook mode: receiving updates at {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+            await asyncio.Event().wait()
+        else:
+            if cluster.peers:
+                logger.warning("Other nodes are alive but this node is polling; run every replica in webhook mode "
+                               "behind a load balancer")
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        await runner.cleanup()
+        await cluster.stop()
+        await live_tails.stop_all()
+        await broadcasts.stop()
+        await warm_pool.stop()
+        await metrics.stop()
+        await write_behind.stop()
+        await bot.session.close()
+        await asyncio.to_thread(db.close)
+        worker_pool.shutdown(wait=False)
 
 if __name__ == "__main__":
     asyncio.run(main())
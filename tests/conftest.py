@@ -0,0 +1,25 @@
+import importlib.util
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope='session')
+def main(tmp_path_factory):
+    # main.py creates its database and upload folders next to itself on import, so load a copy from a scratch dir
+    # instead of touching the checkout.
+    os.environ.setdefault('BOT_TOKEN', '1:test')
+    os.environ.setdefault('OWNER_ID_STR', '1000')
+    os.environ.setdefault('ADMIN_ID_STR', '1001')
+    base = tmp_path_factory.mktemp('bot')
+    shutil.copy(ROOT / 'main.py', base / 'main.py')
+    spec = importlib.util.spec_from_file_location('main', base / 'main.py')
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['main'] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,35 @@
+import signal
+import subprocess
+import time
+
+
+def spawn_tree(children):
+    process = subprocess.Popen(['sh', '-c', f'for i in $(seq {children}); do sleep 30 & done; wait'],
+                               start_new_session=True)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        output = subprocess.run(['pgrep', '-P', str(process.pid)], capture_output=True, text=True).stdout
+        if len(output.split()) >= children:
+            break
+        time.sleep(0.05)
+    return process
+
+
+def test_script_over_process_cap_is_killed(main):
+    process = spawn_tree(5)
+    stats = main.MetricsSampler(5, 10).sample({'1_bot.py': process.pid}, {'1_bot.py': 4})['scripts']['1_bot.py']
+    assert stats['processes'] == 6
+    assert stats['killed']
+    assert process.wait(timeout=5) == -9
+
+
+def test_script_within_process_cap_keeps_running(main):
+    process = spawn_tree(2)
+    try:
+        stats = main.MetricsSampler(5, 10).sample({'1_bot.py': process.pid}, {'1_bot.py': 4})['scripts']['1_bot.py']
+        assert stats['processes'] == 3
+        assert not stats['killed']
+        assert process.poll() is None
+    finally:
+        main.signal_process_tree(process.pid, signal.SIGKILL)
+        process.wait()
@@ -0,0 +1,22 @@
+def plan(main, policy, state, consecutive=0, runtime=1):
+    return main.ScriptSupervisor(None)._plan_restart('1_bot.py', 1, policy, consecutive, state, runtime)
+
+
+def test_always_restarts_unknown_exit(main):
+    delay, consecutive, reason = plan(main, 'always', 'unknown')
+    assert delay is not None
+    assert reason is None
+
+
+def test_on_failure_treats_unknown_exit_as_failure(main):
+    delay, consecutive, reason = plan(main, 'on-failure', 'unknown')
+    assert delay is not None
+    assert consecutive == 1
+
+
+def test_on_failure_ignores_clean_exit(main):
+    assert plan(main, 'on-failure', 'exited') == (None, 0, None)
+
+
+def test_stopped_is_never_restarted(main):
+    assert plan(main, 'always', 'stopped')[0] is None
@@ -0,0 +1,26 @@
+import zipfile
+
+import pytest
+
+
+def make_zip(path, name, data):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(name, data)
+    return path
+
+
+def test_small_compressible_file_is_accepted(main, tmp_path):
+    archive = make_zip(tmp_path / 'project.zip', 'notes.txt', b' ' * 5 * 1024)
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+    assert main.extract_zip_archive(archive, dest, {}) == ['notes.txt']
+    assert (dest / 'notes.txt').read_bytes() == b' ' * 5 * 1024
+
+
+def test_large_entry_with_bomb_ratio_is_rejected(main, tmp_path):
+    archive = make_zip(tmp_path / 'bomb.zip', 'zeros.bin', bytes(4 * 1024 * 1024))
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+    with pytest.raises(ValueError, match='compression ratio'):
+        main.extract_zip_archive(archive, dest, {})
+    assert list(dest.iterdir()) == []